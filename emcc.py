@@ -22,9 +22,7 @@ emcc can be influenced by a few environment variables:
 
 from tools.toolchain_profiler import ToolchainProfiler
 
-import base64
-import glob
-import hashlib
+import functools
 import json
 import logging
 import os
@@ -34,14 +32,12 @@ import shutil
 import stat
 import sys
 import time
-import tarfile
+from collections import deque
 from enum import Enum, unique, auto
 from subprocess import PIPE
-from urllib.parse import quote
 
 
-import emscripten
-from tools import shared, system_libs, utils, ports, filelock
+from tools import shared, utils, filelock
 from tools import colored_logger, diagnostics, building
 from tools.shared import unsuffixed, unsuffixed_basename, WINDOWS, safe_copy
 from tools.shared import run_process, read_and_preprocess, exit_with_error, DEBUG
@@ -60,29 +56,40 @@ from tools.utils import read_file, write_file, read_binary, delete_file, removep
 logger = logging.getLogger('emcc')
 
 # endings = dot + a suffix, compare against result of shared.suffix()
-C_ENDINGS = ['.c', '.i']
-CXX_ENDINGS = ['.cppm', '.pcm', '.cpp', '.cxx', '.cc', '.c++', '.CPP', '.CXX', '.C', '.CC', '.C++', '.ii']
-OBJC_ENDINGS = ['.m', '.mi']
-PREPROCESSED_ENDINGS = ['.i', '.ii']
-OBJCXX_ENDINGS = ['.mm', '.mii']
-SPECIAL_ENDINGLESS_FILENAMES = [os.devnull]
-C_ENDINGS += SPECIAL_ENDINGLESS_FILENAMES # consider the special endingless filenames like /dev/null to be C
-
-SOURCE_ENDINGS = C_ENDINGS + CXX_ENDINGS + OBJC_ENDINGS + OBJCXX_ENDINGS + ['.ll', '.S']
+C_ENDINGS = frozenset({'.c', '.i'})
+CXX_ENDINGS = frozenset({'.cppm', '.pcm', '.cpp', '.cxx', '.cc', '.c++', '.CPP', '.CXX', '.C', '.CC', '.C++', '.ii'})
+OBJC_ENDINGS = frozenset({'.m', '.mi'})
+PREPROCESSED_ENDINGS = frozenset({'.i', '.ii'})
+OBJCXX_ENDINGS = frozenset({'.mm', '.mii'})
+SPECIAL_ENDINGLESS_FILENAMES = frozenset({os.devnull})
+C_ENDINGS |= SPECIAL_ENDINGLESS_FILENAMES # consider the special endingless filenames like /dev/null to be C
+
+SOURCE_ENDINGS = C_ENDINGS | CXX_ENDINGS | OBJC_ENDINGS | OBJCXX_ENDINGS | {'.ll', '.S'}
+
+# Maps source file suffixes to the language they are compiled as.
+SUFFIX_TO_LANG = {
+  **dict.fromkeys(C_ENDINGS, 'c'),
+  **dict.fromkeys(CXX_ENDINGS, 'c++'),
+  **dict.fromkeys(OBJC_ENDINGS, 'objc'),
+  **dict.fromkeys(OBJCXX_ENDINGS, 'objc++'),
+}
 
-EXECUTABLE_ENDINGS = ['.wasm', '.html', '.js', '.mjs', '.out', '']
+EXECUTABLE_ENDINGS = frozenset({'.wasm', '.html', '.js', '.mjs', '.out', ''})
+# These two are kept as lists since find_library searches for them in order.
 DYNAMICLIB_ENDINGS = ['.dylib', '.so'] # Windows .dll suffix is not included in this list, since those are never linked to directly on the command line.
 STATICLIB_ENDINGS = ['.a']
-ASSEMBLY_ENDINGS = ['.s']
-HEADER_ENDINGS = ['.h', '.hxx', '.hpp', '.hh', '.H', '.HXX', '.HPP', '.HH']
+ASSEMBLY_ENDINGS = frozenset({'.s'})
+HEADER_ENDINGS = frozenset({'.h', '.hxx', '.hpp', '.hh', '.H', '.HXX', '.HPP', '.HH'})
+# Inputs that phase_compile_inputs passes to clang to compile.
+COMPILE_ENDINGS = SOURCE_ENDINGS | ASSEMBLY_ENDINGS
 
 # Supported LLD flags which we will pass through to the linker.
-SUPPORTED_LINKER_FLAGS = (
+SUPPORTED_LINKER_FLAGS = frozenset({
     '--start-group', '--end-group',
     '-(', '-)',
     '--whole-archive', '--no-whole-archive',
     '-whole-archive', '-no-whole-archive'
-)
+})
 
 # Unsupported LLD flags which we will ignore.
 # Maps to true if the flag takes an argument.
@@ -98,6 +105,8 @@ UNSUPPORTED_LLD_FLAGS = {
     '-version-script': True,
     '-install_name': True,
 }
+# lld allows various flags to have either a single -foo or double --foo
+UNSUPPORTED_LLD_FLAGS_RE = re.compile('-?(%s)' % '|'.join(re.escape(f) for f in UNSUPPORTED_LLD_FLAGS))
 
 DEFAULT_ASYNCIFY_IMPORTS = [
   'wasi_snapshot_preview1.fd_sync', '__wasi_fd_sync', '__asyncjs__*'
@@ -112,6 +121,55 @@ DEFAULT_ASYNCIFY_EXPORTS = [
   '_ZN10emscripten8internal5async*'
 ]
 
+# Helper functions for JS to call into C to do memory operations.  These let us
+# sanitize memory access from the JS side, by calling into C where it has been
+# instrumented.
+ASAN_C_HELPERS = [
+  '_asan_c_load_1', '_asan_c_load_1u',
+  '_asan_c_load_2', '_asan_c_load_2u',
+  '_asan_c_load_4', '_asan_c_load_4u',
+  '_asan_c_load_f', '_asan_c_load_d',
+  '_asan_c_store_1', '_asan_c_store_1u',
+  '_asan_c_store_2', '_asan_c_store_2u',
+  '_asan_c_store_4', '_asan_c_store_4u',
+  '_asan_c_store_f', '_asan_c_store_d',
+]
+
+# Exports needed by the WasmFS JS API.
+WASMFS_JS_API_EXPORTS = [
+  '_wasmfs_read_file',
+  '_wasmfs_write_file',
+  '_wasmfs_open',
+  '_wasmfs_allocate',
+  '_wasmfs_close',
+  '_wasmfs_write',
+  '_wasmfs_pwrite',
+  '_wasmfs_rename',
+  '_wasmfs_mkdir',
+  '_wasmfs_unlink',
+  '_wasmfs_chdir',
+  '_wasmfs_mknod',
+  '_wasmfs_rmdir',
+  '_wasmfs_read',
+  '_wasmfs_pread',
+  '_wasmfs_symlink',
+  '_wasmfs_truncate',
+  '_wasmfs_ftruncate',
+  '_wasmfs_stat',
+  '_wasmfs_lstat',
+  '_wasmfs_chmod',
+  '_wasmfs_fchmod',
+  '_wasmfs_lchmod',
+  '_wasmfs_utime',
+  '_wasmfs_llseek',
+  '_wasmfs_identify',
+  '_wasmfs_readlink',
+  '_wasmfs_readdir_start',
+  '_wasmfs_readdir_get',
+  '_wasmfs_readdir_finish',
+  '_wasmfs_get_cwd',
+]
+
 # Target options
 final_js = None
 
@@ -160,6 +218,17 @@ EXTRA_INCOMING_JS_API = [
 
 VALID_ENVIRONMENTS = ('web', 'webview', 'worker', 'node', 'shell')
 SIMD_INTEL_FEATURE_TOWER = ['-msse', '-msse2', '-msse3', '-mssse3', '-msse4.1', '-msse4.2', '-msse4', '-mavx']
+# Preprocessor defines implied by each level of SIMD_INTEL_FEATURE_TOWER (__SSE__
+# is handled separately since it is also implied by the NEON flags).  Note
+# that -msse4 is an alias of -msse4.2, and so both imply __SSE4_2__.
+SIMD_INTEL_FEATURE_DEFINES = [
+  ('__SSE2__', 1),
+  ('__SSE3__', 2),
+  ('__SSSE3__', 3),
+  ('__SSE4_1__', 4),
+  ('__SSE4_2__', 5),
+  ('__AVX__', 7),
+]
 SIMD_NEON_FLAGS = ['-mfpu=neon']
 COMPILE_ONLY_FLAGS = {'--default-obj-ext'}
 LINK_ONLY_FLAGS = {
@@ -172,6 +241,63 @@ LINK_ONLY_FLAGS = {
     '--threadprofiler', '--use-preload-plugins'
 }
 
+# Flags that take their value as a separate argument, which phase_setup must
+# skip over when looking for input files.
+SKIP_NEXT_ARGS = {
+    '-MT', '-MF', '-MJ', '-MQ', '-D', '-U', '-o', '-x',
+    '-Xpreprocessor', '-include', '-imacros', '-idirafter',
+    '-iprefix', '-iwithprefix', '-iwithprefixbefore',
+    '-isysroot', '-imultilib', '-A', '-isystem', '-iquote',
+    '-install_name', '-compatibility_version',
+    '-current_version', '-I', '-L', '-include-pch',
+    '-undefined',
+    '-Xlinker', '-Xclang', '-z'
+}
+
+# The two character prefixes of the arguments that phase_setup needs to look
+# at other than input files.  Everything else is left for the compiler.
+LINK_FLAG_PREFIXES = {'-L', '-l', '-z', '-W', '-X', '-s', '-'}
+
+# Compiler flags that make every clang process write to the same file (e.g. a
+# fixed dependency file or compilation database fragment).  Multiple source
+# files are compiled one at a time when any of these are present.  These are
+# matched as prefixes, so e.g. `-save-temps=obj` is covered too.
+SHARED_OUTPUT_COMPILE_FLAGS = ('-MJ', '-MF', '-Wp,-M', '-save-temps', '--save-temps')
+
+# Any of these settings implies RUNTIME_DEBUG.
+RUNTIME_DEBUG_SETTINGS = (
+    'LIBRARY_DEBUG',
+    'GL_DEBUG',
+    'DYLINK_DEBUG',
+    'OPENAL_DEBUG',
+    'SYSCALL_DEBUG',
+    'WEBSOCKET_DEBUG',
+    'SOCKET_DEBUG',
+    'FETCH_DEBUG',
+    'EXCEPTION_DEBUG',
+    'PTHREADS_DEBUG',
+    'ASYNCIFY_DEBUG',
+)
+
+# Minimum number of input files in a single directory before phase_setup lists
+# the directory instead of checking each file for existence.
+LIST_DIR_THRESHOLD = 16
+
+MIN_VERSION_RE = re.compile(r'MIN_.*_VERSION(=.*)?')
+BYTE_SIZE_RE = re.compile(r'^(\d+)\s*([kmgt]?b)?$', re.I)
+SIZE_SUFFIXES = {suffix: 1024 ** i for i, suffix in enumerate(['b', 'kb', 'mb', 'gb', 'tb'])}
+EXPORT_NAME_SUBSTITUTION_RE = re.compile(r'{\s*[\'"]?__EMSCRIPTEN_PRIVATE_MODULE_EXPORT_NAME_SUBSTITUTION__[\'"]?:\s*1\s*}')
+# Flags that are accepted for compatibility but no longer have any effect,
+# mapped to the warning we emit for them.
+LEGACY_IGNORED_FLAGS = {
+    '--no-heap-copy': 'ignoring legacy flag --no-heap-copy (that is the only mode supported now)',
+    '--remove-duplicates': '--remove-duplicates is deprecated as it is no longer needed. If you cannot link without it, file a bug with a testcase',
+}
+# Mangled `import.meta` and `await import` references (see `preprocess` in
+# parseTools.js) and what they are unmangled to.
+ES6_IMPORT_META_RE = re.compile(r'EMSCRIPTEN\$(IMPORT\$META|AWAIT\$IMPORT)')
+ES6_IMPORT_META_REPLACEMENTS = {'IMPORT$META': 'import.meta', 'AWAIT$IMPORT': 'await import'}
+
 
 # this function uses the global 'final' variable, which contains the current
 # final output file. if a method alters final, and calls this method, then it
@@ -196,10 +322,29 @@ def save_intermediate_with_wasm(name, wasm_binary):
 
 
 def base64_encode(b):
+  import base64
   b64 = base64.b64encode(b)
   return b64.decode('ascii')
 
 
+def base64_encode_file(filename, out):
+  """Base64 encode the contents of a file, writing the result to the text
+  stream `out` one chunk at a time, so that neither the file contents nor the
+  full encoding is held in memory."""
+  import base64
+  with open(filename, 'rb') as f:
+    while True:
+      # Use a multiple of 3 bytes so that no padding is emitted mid-stream.
+      chunk = f.read(3 * 64 * 1024)
+      if not chunk:
+        break
+      out.write(base64.b64encode(chunk).decode('ascii'))
+
+
+# The wasm page size is a power of two so this can be used to test alignment.
+WASM_PAGE_MASK = webassembly.WASM_PAGE_SIZE - 1
+
+
 def align_to_wasm_page_boundary(address):
   page_size = webassembly.WASM_PAGE_SIZE
   return ((address + (page_size - 1)) // page_size) * page_size
@@ -217,6 +362,14 @@ class OFormat(Enum):
   BARE = auto()
 
 
+# Output formats that are implied by the output filename's extension.
+SUFFIX_TO_OFORMAT = {
+    '.wasm': OFormat.WASM,
+    '.mjs': OFormat.MJS,
+    '.html': OFormat.HTML,
+}
+
+
 @unique
 class Mode(Enum):
   PREPROCESS_ONLY = auto()
@@ -303,7 +456,17 @@ def create_reproduce_file(name, args):
     return filename
 
   root = unsuffixed_basename(name)
-  with tarfile.open(name, 'w') as reproduce_file:
+  mode = 'w'
+  kwargs = {}
+  if name.endswith(('.tar.gz', '.tgz')):
+    # The reproducer is written once and typically read once, so favor
+    # compression speed over size.
+    mode = 'w:gz'
+    kwargs['compresslevel'] = 1
+    if name.endswith('.tar.gz'):
+      root = unsuffixed(root)
+  import tarfile
+  with tarfile.open(name, mode, **kwargs) as reproduce_file:
     reproduce_file.add(shared.path_from_root('emscripten-version.txt'), os.path.join(root, 'version.txt'))
 
     with shared.get_temp_files().get_file(suffix='.tar') as rsp_name:
@@ -400,14 +563,13 @@ def expand_byte_size_suffixes(value):
   many bytes that is and returns it as an integer.
   """
   value = value.strip()
-  match = re.match(r'^(\d+)\s*([kmgt]?b)?$', value, re.I)
+  match = BYTE_SIZE_RE.match(value)
   if not match:
     exit_with_error("invalid byte size `%s`.  Valid suffixes are: kb, mb, gb, tb" % value)
   value, suffix = match.groups()
   value = int(value)
   if suffix:
-    size_suffixes = {suffix: 1024 ** i for i, suffix in enumerate(['b', 'kb', 'mb', 'gb', 'tb'])}
-    value *= size_suffixes[suffix.lower()]
+    value *= SIZE_SUFFIXES[suffix.lower()]
   return value
 
 
@@ -416,6 +578,13 @@ def default_setting(name, new_default):
     setattr(settings, name, new_default)
 
 
+def default_settings(**new_defaults):
+  """Like default_setting but for several settings at once."""
+  for name, new_default in new_defaults.items():
+    if name not in user_settings:
+      setattr(settings, name, new_default)
+
+
 def apply_user_settings():
   """Take a map of users settings {NAME: VALUE} and apply them to the global
   settings object.
@@ -424,15 +593,20 @@ def apply_user_settings():
   # Stash a copy of all available incoming APIs before the user can potentially override it
   settings.ALL_INCOMING_MODULE_JS_API = settings.INCOMING_MODULE_JS_API + EXTRA_INCOMING_JS_API
 
+  internal_settings = settings.internal_settings
+  legacy_settings = settings.legacy_settings
+  alt_names = settings.alt_names
+  setting_types = settings.types
+
   for key, value in user_settings.items():
-    if key in settings.internal_settings:
+    if key in internal_settings:
       exit_with_error('%s is an internal setting and cannot be set from command line', key)
 
     # map legacy settings which have aliases to the new names
     # but keep the original key so errors are correctly reported via the `setattr` below
     user_key = key
-    if key in settings.legacy_settings and key in settings.alt_names:
-      key = settings.alt_names[key]
+    if key in legacy_settings and key in alt_names:
+      key = alt_names[key]
 
     # In those settings fields that represent amount of memory, translate suffixes to multiples of 1024.
     if key in MEM_SIZE_SETTINGS:
@@ -447,9 +621,11 @@ def apply_user_settings():
     else:
       value = value.replace('\\', '\\\\')
 
-    expected_type = settings.types.get(key)
+    expected_type = setting_types.get(key)
 
-    if filename and expected_type == list and value.strip()[0] != '[':
+    # `value` has already been stripped here, so avoid re-scanning (and
+    # copying) what can be a very large symbol list.
+    if filename and expected_type == list and value[:1] != '[':
       # Prefer simpler one-line-per value parser
       value = parse_symbol_list_file(value)
     else:
@@ -476,15 +652,20 @@ def is_ar_file_with_missing_index(archive_file):
   archive_header = b'!<arch>\n'
   file_header_size = 60
 
-  with open(archive_file, 'rb') as f:
-    header = f.read(len(archive_header))
-    if header != archive_header:
-      # This is not even an ar file
-      return False
-    file_header = f.read(file_header_size)
-    if len(file_header) != file_header_size:
-      # We don't have any file entires at all so we don't consider the index missing
-      return False
+  # Read both headers with a single unbuffered read.
+  fd = os.open(archive_file, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+  try:
+    data = os.read(fd, len(archive_header) + file_header_size)
+  finally:
+    os.close(fd)
+
+  if not data.startswith(archive_header):
+    # This is not even an ar file
+    return False
+  file_header = data[len(archive_header):]
+  if len(file_header) != file_header_size:
+    # We don't have any file entires at all so we don't consider the index missing
+    return False
 
   name = file_header[:16].strip()
   # If '/' is the name of the first file we have an index
@@ -508,11 +689,18 @@ def generate_js_sym_info():
   # TODO(sbc): Find a way to optimize this.  Potentially we could add a super-set
   # mode of the js compiler that would generate a list of all possible symbols
   # that could be checked in.
+  import emscripten
   _, forwarded_data = emscripten.compile_javascript(symbols_only=True)
   # When running in symbols_only mode compiler.js outputs a flat list of C symbols.
   return json.loads(forwarded_data)
 
 
+@shared.memoize
+def get_system_js_libraries():
+  import glob
+  return sorted(glob.glob(utils.path_from_root('src') + '/library*.js'))
+
+
 @ToolchainProfiler.profile_block('JS symbol generation')
 def get_js_sym_info():
   # Avoiding using the cache when generating struct info since
@@ -520,25 +708,60 @@ def get_js_sym_info():
   if DEBUG or settings.BOOTSTRAPPING_STRUCT_INFO or config.FROZEN_CACHE:
     return generate_js_sym_info()
 
+  import hashlib
+  import heapq
+
   # We define a cache hit as when the settings and `--js-library` contents are
   # identical.
   # Ignore certain settings that can are no relevant to library deps.  Here we
   # skip PRE_JS_FILES/POST_JS_FILES which don't effect the library symbol list
   # and can contain full paths to temporary files.
   skip_settings = {'PRE_JS_FILES', 'POST_JS_FILES'}
-  input_files = [json.dumps(settings.external_dict(skip_keys=skip_settings), sort_keys=True, indent=2)]
-  for jslib in sorted(glob.glob(utils.path_from_root('src') + '/library*.js')):
-    input_files.append(read_file(jslib))
+  settings_json = json.dumps(settings.external_dict(skip_keys=skip_settings), sort_keys=True, indent=2)
+  jslibs = list(get_system_js_libraries())
   for jslib in settings.JS_LIBRARIES:
     if not os.path.isabs(jslib):
       jslib = utils.path_from_root('src', jslib)
-    input_files.append(read_file(jslib))
-  content = '\n'.join(input_files)
-  content_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    jslibs.append(jslib)
+
+  # Computing the content hash means reading every JS library, so we keep an
+  # index of the digest of each library keyed on its mtime and size.  Only the
+  # libraries that have changed since they were last indexed need to be read.
+  index_file = cache.get_path('symbol_lists.stat_index.json')
+
+  def read_index():
+    try:
+      return json.loads(read_binary(index_file))
+    except (OSError, ValueError):
+      return {}
+
+  index = read_index()
+  updated_entries = {}
+  # This is only used as a cache key, so use blake2b which is faster than sha1.
+  content_hash = hashlib.blake2b(settings_json.encode('utf-8'), digest_size=16)
+  for jslib in jslibs:
+    st = os.stat(jslib)
+    stat_key = [st.st_mtime_ns, st.st_size]
+    entry = index.get(jslib)
+    if entry and entry[:2] == stat_key:
+      digest = entry[2]
+    else:
+      digest = hashlib.blake2b(read_binary(jslib), digest_size=16).hexdigest()
+      updated_entries[jslib] = stat_key + [digest]
+    content_hash.update(digest.encode('utf-8'))
+  content_hash = content_hash.hexdigest()
+
+  # Limit of the overall size of the cache to 100 files.
+  # This code will get test coverage since a full test run of `other` or `core`
+  # generates ~1000 unique symbol lists.
+  cache_limit = 500
+  cache_miss = False
 
   def build_symbol_list(filename):
     """Only called when there is no existing symbol list for a given content hash.
     """
+    nonlocal cache_miss
+    cache_miss = True
     library_syms = generate_js_sym_info()
 
     write_file(filename, json.dumps(library_syms, separators=(',', ':'), indent=2))
@@ -548,22 +771,34 @@ def get_js_sym_info():
   # can be deleted between the `cache.get()` then the `read_file`.
   with filelock.FileLock(cache.get_path(cache.get_path('symbol_lists.lock'))):
     filename = cache.get(f'symbol_lists/{content_hash}.json', build_symbol_list)
-    library_syms = json.loads(read_file(filename))
-
-    # Limit of the overall size of the cache to 100 files.
-    # This code will get test coverage since a full test run of `other` or `core`
-    # generates ~1000 unique symbol lists.
-    cache_limit = 500
-    root = cache.get_path('symbol_lists')
-    if len(os.listdir(root)) > cache_limit:
-      files = []
-      for f in os.listdir(root):
-        f = os.path.join(root, f)
-        files.append((f, os.path.getmtime(f)))
-      files.sort(key=lambda x: x[1])
-      # Delete all but the newest N files
-      for f, _ in files[:-cache_limit]:
-        delete_file(f)
+    library_syms = json.loads(read_binary(filename))
+
+    if updated_entries:
+      # Re-read the index now that we hold the lock in case another process
+      # updated it in the meantime.
+      index = read_index()
+      for jslib, entry in updated_entries.items():
+        index.pop(jslib, None)
+        index[jslib] = entry
+      # Entries are kept in insertion order so drop the oldest ones first.
+      for jslib in list(index)[:-cache_limit]:
+        del index[jslib]
+      # Write the new index alongside and move it into place so that readers
+      # that don't hold the lock never see a partially written file.
+      temp_index_file = str(index_file) + '.tmp'
+      write_file(temp_index_file, json.dumps(index))
+      os.replace(temp_index_file, index_file)
+
+    # The symbol list directory can only have grown if we just generated a
+    # new entry.
+    if cache_miss:
+      with os.scandir(cache.get_path('symbol_lists')) as it:
+        entries = list(it)
+      if len(entries) > cache_limit:
+        # Delete all but the newest N files
+        oldest = heapq.nsmallest(len(entries) - cache_limit, entries, key=lambda e: e.stat().st_mtime)
+        for entry in oldest:
+          delete_file(entry.path)
 
   return library_syms
 
@@ -571,15 +806,14 @@ def get_js_sym_info():
 def filter_link_flags(flags, using_lld):
   def is_supported(f):
     if using_lld:
-      for flag, takes_arg in UNSUPPORTED_LLD_FLAGS.items():
-        # lld allows various flags to have either a single -foo or double --foo
-        if f.startswith(flag) or f.startswith('-' + flag):
-          diagnostics.warning('linkflags', 'ignoring unsupported linker flag: `%s`', f)
-          # Skip the next argument if this linker flag takes and argument and that
-          # argument was not specified as a separately (i.e. it was specified as
-          # single arg containing an `=` char.)
-          skip_next = takes_arg and '=' not in f
-          return False, skip_next
+      match = UNSUPPORTED_LLD_FLAGS_RE.match(f)
+      if match:
+        diagnostics.warning('linkflags', 'ignoring unsupported linker flag: `%s`', f)
+        # Skip the next argument if this linker flag takes and argument and that
+        # argument was not specified as a separately (i.e. it was specified as
+        # single arg containing an `=` char.)
+        skip_next = UNSUPPORTED_LLD_FLAGS[match.group(1)] and '=' not in f
+        return False, skip_next
       return True, False
     else:
       if f in SUPPORTED_LINKER_FLAGS:
@@ -612,6 +846,8 @@ def fix_windows_newlines(text):
 
 
 def read_js_files(files):
+  if not files:
+    return ''
   contents = '\n'.join(read_file(f) for f in files)
   return fix_windows_newlines(contents)
 
@@ -649,21 +885,17 @@ def get_binaryen_passes():
     passes += ['--post-emscripten']
     if settings.SIDE_MODULE:
       passes += ['--pass-arg=post-emscripten-side-module']
-  if optimizing:
     passes += [building.opt_level_to_str(settings.OPT_LEVEL, settings.SHRINK_LEVEL)]
-  # when optimizing, use the fact that low memory is never used (1024 is a
-  # hardcoded value in the binaryen pass)
-  if optimizing and settings.GLOBAL_BASE >= 1024:
-    passes += ['--low-memory-unused']
+    # when optimizing, use the fact that low memory is never used (1024 is a
+    # hardcoded value in the binaryen pass)
+    if settings.GLOBAL_BASE >= 1024:
+      passes += ['--low-memory-unused']
   if settings.AUTODEBUG:
     # adding '--flatten' here may make these even more effective
-    passes += ['--instrument-locals']
-    passes += ['--log-execution']
-    passes += ['--instrument-memory']
+    passes += ['--instrument-locals', '--log-execution', '--instrument-memory']
     if settings.LEGALIZE_JS_FFI:
       # legalize it again now, as the instrumentation may need it
-      passes += ['--legalize-js-interface']
-      passes += building.js_legalization_pass_flags()
+      passes += ['--legalize-js-interface'] + building.js_legalization_pass_flags()
   if settings.EMULATE_FUNCTION_POINTER_CASTS:
     # note that this pass must run before asyncify, as if it runs afterwards we only
     # generate the  byn$fpcast_emu  functions after asyncify runs, and so we wouldn't
@@ -702,9 +934,9 @@ def get_binaryen_passes():
       check_human_readable_list(settings.ASYNCIFY_ONLY)
       passes += ['--pass-arg=asyncify-onlylist@%s' % ','.join(settings.ASYNCIFY_ONLY)]
   elif settings.ASYNCIFY == 2:
-    passes += ['--jspi']
-    passes += ['--pass-arg=jspi-imports@%s' % ','.join(settings.ASYNCIFY_IMPORTS)]
-    passes += ['--pass-arg=jspi-exports@%s' % ','.join(settings.ASYNCIFY_EXPORTS)]
+    passes += ['--jspi',
+               '--pass-arg=jspi-imports@%s' % ','.join(settings.ASYNCIFY_IMPORTS),
+               '--pass-arg=jspi-exports@%s' % ','.join(settings.ASYNCIFY_EXPORTS)]
     if settings.SPLIT_MODULE:
       passes += ['--pass-arg=jspi-split-module']
 
@@ -716,12 +948,12 @@ def get_binaryen_passes():
   # the one exception is dynamic linking of a side module: the main module is ok
   # as it is loaded first, but the side module may be assigned memory that was
   # previously used.
-  if optimizing and not settings.SIDE_MODULE:
-    passes += ['--zero-filled-memory']
-  # LLVM output always has immutable initial table contents: the table is
-  # fixed and may only be appended to at runtime (that is true even in
-  # relocatable mode)
   if optimizing:
+    if not settings.SIDE_MODULE:
+      passes += ['--zero-filled-memory']
+    # LLVM output always has immutable initial table contents: the table is
+    # fixed and may only be appended to at runtime (that is true even in
+    # relocatable mode)
     passes += ['--pass-arg=directize-initial-contents-immutable']
 
   if settings.BINARYEN_EXTRA_PASSES:
@@ -776,7 +1008,9 @@ def is_dash_s_for_emcc(args, i):
     arg = args[i + 1]
   else:
     arg = removeprefix(args[i], '-s')
-  arg = arg.split('=')[0]
+  # Only the setting name matters here, so avoid splitting the (potentially
+  # very long) value.
+  arg = arg.partition('=')[0]
   return arg.isidentifier() and arg.isupper()
 
 
@@ -801,60 +1035,75 @@ def filter_out_duplicate_dynamic_libs(inputs):
   # See test_core.py:test_redundant_link
   def check(input_file):
     if get_file_suffix(input_file) in DYNAMICLIB_ENDINGS and not building.is_wasm_dylib(input_file):
-      abspath = os.path.abspath(input_file)
-      if abspath in seen:
+      # Use the realpath so that symlinks such as libfoo.so -> libfoo.so.1
+      # are also treated as duplicates.
+      realpath = os.path.realpath(input_file)
+      if realpath in seen:
         return False
-      seen.add(abspath)
+      seen.add(realpath)
     return True
 
   return [f for f in inputs if check(f)]
 
 
 def process_dynamic_libs(dylibs, lib_dirs):
-  extras = []
   seen = set()
-  to_process = dylibs.copy()
+  to_process = deque(dylibs)
+  # Read everything we need from each library in one go, rather than opening
+  # and parsing it again for its exports and imports below.  Libraries are
+  # keyed on their realpath so that a library reached via more than one name
+  # is only processed once.
+  dylib_info = {}
   while to_process:
-    dylib = to_process.pop()
-    dylink = webassembly.parse_dylink_section(dylib)
+    dylib = to_process.popleft()
+    realpath = os.path.realpath(dylib)
+    if realpath in dylib_info:
+      continue
+    with webassembly.Module(dylib) as module:
+      dylink = module.parse_dylink_section()
+      dylib_info[realpath] = (dylib, module.get_exports(), module.get_imports())
     for needed in dylink.needed:
       if needed in seen:
         continue
       path = find_library(needed, lib_dirs)
-      if path:
-        extras.append(path)
-        seen.add(needed)
-      else:
+      if not path:
         exit_with_error(f'{os.path.normpath(dylib)}: shared library dependency not found: `{needed}`')
+      seen.add(needed)
       to_process.append(path)
 
-  dylibs += extras
-  for dylib in dylibs:
-    exports = webassembly.get_exports(dylib)
-    exports = set(e.name for e in exports)
+  # Accumulate symbols from all libraries before updating the settings, so
+  # symbols shared between libraries are only added once.
+  all_exports = set()
+  all_imports = set()
+  all_strong_imports = set()
+  for dylib, exports, imports in dylib_info.values():
     # EM_JS function are exports with a special prefix.  We need to strip
     # this prefix to get the actaul symbol name.  For the main module, this
     # is handled by extract_metadata.py.
-    exports = [removeprefix(e, '__em_js__') for e in exports]
-    settings.SIDE_MODULE_EXPORTS.extend(sorted(exports))
+    exports = {removeprefix(e.name, '__em_js__') for e in exports}
+    all_exports |= exports
 
-    imports = webassembly.get_imports(dylib)
-    imports = [i.field for i in imports if i.kind in (webassembly.ExternType.FUNC, webassembly.ExternType.GLOBAL, webassembly.ExternType.TAG)]
     # For now we ignore `invoke_` functions imported by side modules and rely
     # on the dynamic linker to create them on the fly.
     # TODO(sbc): Integrate with metadata.invokeFuncs that comes from the
     # main module to avoid creating new invoke functions at runtime.
-    imports = set(imports)
-    imports = set(i for i in imports if not i.startswith('invoke_'))
-    strong_imports = sorted(imports.difference(exports))
+    imports = {i.field for i in imports
+               if i.kind in (webassembly.ExternType.FUNC, webassembly.ExternType.GLOBAL, webassembly.ExternType.TAG)
+               and not i.field.startswith('invoke_')}
     logger.debug('Adding symbols requirements from `%s`: %s', dylib, imports)
+    all_imports |= imports
+    all_strong_imports |= imports.difference(exports)
 
-    mangled_imports = [shared.asmjs_mangle(e) for e in sorted(imports)]
-    mangled_strong_imports = [shared.asmjs_mangle(e) for e in strong_imports]
-    settings.SIDE_MODULE_IMPORTS.extend(mangled_imports)
-    settings.EXPORT_IF_DEFINED.extend(sorted(imports))
-    settings.DEFAULT_LIBRARY_FUNCS_TO_INCLUDE.extend(sorted(imports))
-    building.user_requested_exports.update(mangled_strong_imports)
+  settings.SIDE_MODULE_EXPORTS.extend(sorted(all_exports))
+  # asmjs_mangle depends on settings, so rather than caching it globally
+  # mangle each unique import once here.  Strong imports are a subset of all
+  # imports so they can reuse the same results.
+  mangled = {e: shared.asmjs_mangle(e) for e in all_imports}
+  all_imports = sorted(all_imports)
+  settings.SIDE_MODULE_IMPORTS.extend(mangled[e] for e in all_imports)
+  settings.EXPORT_IF_DEFINED.extend(all_imports)
+  settings.DEFAULT_LIBRARY_FUNCS_TO_INCLUDE.extend(all_imports)
+  building.user_requested_exports.update(mangled[e] for e in all_strong_imports)
 
 
 def unmangle_symbols_from_cmdline(symbols):
@@ -868,69 +1117,58 @@ def unmangle_symbols_from_cmdline(symbols):
 
 def parse_s_args(args):
   settings_changes = []
-  for i in range(len(args)):
-    if args[i].startswith('-s'):
-      if is_dash_s_for_emcc(args, i):
-        if args[i] == '-s':
-          key = args[i + 1]
-          args[i + 1] = ''
-        else:
-          key = removeprefix(args[i], '-s')
-        args[i] = ''
-
-        # If not = is specified default to 1
-        if '=' not in key:
-          key += '=1'
-
-        # Special handling of browser version targets. A version -1 means that the specific version
-        # is not supported at all. Replace those with INT32_MAX to make it possible to compare e.g.
-        # #if MIN_FIREFOX_VERSION < 68
-        if re.match(r'MIN_.*_VERSION(=.*)?', key):
-          try:
-            if int(key.split('=')[1]) < 0:
-              key = key.split('=')[0] + '=0x7FFFFFFF'
-          except Exception:
-            pass
-
-        settings_changes.append(key)
-
-  newargs = [a for a in args if a]
+  newargs = []
+  i = 0
+  while i < len(args):
+    arg = args[i]
+    i += 1
+    if not arg:
+      continue
+    if not arg.startswith('-s') or not is_dash_s_for_emcc(args, i - 1):
+      newargs.append(arg)
+      continue
+    if arg == '-s':
+      key = args[i]
+      i += 1
+    else:
+      key = removeprefix(arg, '-s')
+
+    # If not = is specified default to 1
+    if '=' not in key:
+      key += '=1'
+
+    # Special handling of browser version targets. A version -1 means that the specific version
+    # is not supported at all. Replace those with INT32_MAX to make it possible to compare e.g.
+    # #if MIN_FIREFOX_VERSION < 68
+    if MIN_VERSION_RE.match(key):
+      try:
+        if int(key.split('=')[1]) < 0:
+          key = key.split('=')[0] + '=0x7FFFFFFF'
+      except Exception:
+        pass
+
+    settings_changes.append(key)
+
   return (settings_changes, newargs)
 
 
 def emsdk_cflags(user_args):
   cflags = ['--sysroot=' + cache.get_sysroot(absolute=True)]
 
-  def array_contains_any_of(hay, needles):
-    for n in needles:
-      if n in hay:
-        return True
+  user_args_set = set(user_args)
+  # Find the highest level of the x86 SIMD feature tower that was requested
+  # (-1 if none), so that each define below is a single comparison.
+  simd_level = max((i for i, flag in enumerate(SIMD_INTEL_FEATURE_TOWER) if flag in user_args_set), default=-1)
+  use_neon = not user_args_set.isdisjoint(SIMD_NEON_FLAGS)
 
-  if array_contains_any_of(user_args, SIMD_INTEL_FEATURE_TOWER) or array_contains_any_of(user_args, SIMD_NEON_FLAGS):
-    if '-msimd128' not in user_args and '-mrelaxed-simd' not in user_args:
+  if simd_level >= 0 or use_neon:
+    if '-msimd128' not in user_args_set and '-mrelaxed-simd' not in user_args_set:
       exit_with_error('Passing any of ' + ', '.join(SIMD_INTEL_FEATURE_TOWER + SIMD_NEON_FLAGS) + ' flags also requires passing -msimd128 (or -mrelaxed-simd)!')
     cflags += ['-D__SSE__=1']
 
-  if array_contains_any_of(user_args, SIMD_INTEL_FEATURE_TOWER[1:]):
-    cflags += ['-D__SSE2__=1']
-
-  if array_contains_any_of(user_args, SIMD_INTEL_FEATURE_TOWER[2:]):
-    cflags += ['-D__SSE3__=1']
-
-  if array_contains_any_of(user_args, SIMD_INTEL_FEATURE_TOWER[3:]):
-    cflags += ['-D__SSSE3__=1']
-
-  if array_contains_any_of(user_args, SIMD_INTEL_FEATURE_TOWER[4:]):
-    cflags += ['-D__SSE4_1__=1']
-
-  # Handle both -msse4.2 and its alias -msse4.
-  if array_contains_any_of(user_args, SIMD_INTEL_FEATURE_TOWER[5:]):
-    cflags += ['-D__SSE4_2__=1']
+  cflags += [f'-D{define}=1' for define, level in SIMD_INTEL_FEATURE_DEFINES if simd_level >= level]
 
-  if array_contains_any_of(user_args, SIMD_INTEL_FEATURE_TOWER[7:]):
-    cflags += ['-D__AVX__=1']
-
-  if array_contains_any_of(user_args, SIMD_NEON_FLAGS):
+  if use_neon:
     cflags += ['-D__ARM_NEON__=1']
 
   if not settings.USE_SDL:
@@ -946,6 +1184,15 @@ def get_target_flags():
 def get_clang_flags(user_args):
   flags = get_target_flags()
 
+  # Scan the user args once for the flag families we check below.
+  has_visibility_flag = False
+  has_lto_flag = False
+  for a in user_args:
+    if a.startswith('-fvisibility'):
+      has_visibility_flag = True
+    elif a.startswith('-flto'):
+      has_lto_flag = True
+
   # if exception catching is disabled, we can prevent that code from being
   # generated in the frontend
   if settings.DISABLE_EXCEPTION_CATCHING and not settings.WASM_EXCEPTIONS:
@@ -961,11 +1208,11 @@ def get_clang_flags(user_args):
   # backend defaults visibility=hidden.  This matched the expectations of C/C++
   # code in the wild which expects undecorated symbols to be exported to other
   # DSO's by default.
-  if not any(a.startswith('-fvisibility') for a in user_args):
+  if not has_visibility_flag:
     flags.append('-fvisibility=default')
 
   if settings.LTO:
-    if not any(a.startswith('-flto') for a in user_args):
+    if not has_lto_flag:
       flags.append('-flto=' + settings.LTO)
     # setjmp/longjmp handling using Wasm EH
     # For non-LTO, '-mllvm -wasm-enable-eh' added in
@@ -983,14 +1230,19 @@ def get_clang_flags(user_args):
   return flags
 
 
-cflags = None
+# Cache of get_cflags results, keyed on the user args and whether we are
+# compiling C++.
+cflags_cache = {}
 
 
 def get_cflags(user_args, is_cxx):
-  global cflags
-  if cflags:
-    return cflags
+  key = (tuple(user_args), is_cxx)
+  if key not in cflags_cache:
+    cflags_cache[key] = compute_cflags(user_args, is_cxx)
+  return cflags_cache[key]
+
 
+def compute_cflags(user_args, is_cxx):
   # Flags we pass to the compiler when building C/C++ code
   # We add these to the user's flags (newargs), but not when building .s or .S assembly files
   cflags = get_clang_flags(user_args)
@@ -1020,6 +1272,7 @@ def get_cflags(user_args, is_cxx):
   if not is_cxx:
     cflags += ['-Werror=implicit-function-declaration']
 
+  from tools import ports
   ports.add_cflags(cflags, settings)
 
   if '-nostdinc' in user_args:
@@ -1029,27 +1282,34 @@ def get_cflags(user_args, is_cxx):
   return cflags
 
 
+@functools.lru_cache(maxsize=4096)
+def split_versioned_suffix(filename):
+  """Splits the basename of a filename into its stem and its essential suffix,
+  discarding Unix-style version numbers.  For example for 'libz.so.1.2.8'
+  returns ('libz', '.so')."""
+  basename = os.path.basename(filename)
+  # As with os.path.splitext, leading dots do not start a suffix.
+  stem = basename.lstrip('.')
+  leading_dots = basename[:len(basename) - len(stem)]
+  parts = stem.split('.')
+  for i in range(len(parts) - 1, 0, -1):
+    if not parts[i].isdigit():
+      return leading_dots + '.'.join(parts[:i]), '.' + parts[i]
+  return leading_dots + parts[0], ''
+
+
 def get_file_suffix(filename):
   """Parses the essential suffix of a filename, discarding Unix-style version
   numbers in the name. For example for 'libz.so.1.2.8' returns '.so'"""
   if filename in SPECIAL_ENDINGLESS_FILENAMES:
     return filename
-  while filename:
-    filename, suffix = os.path.splitext(filename)
-    if not suffix[1:].isdigit():
-      return suffix
-  return ''
+  return split_versioned_suffix(filename)[1]
 
 
 def get_library_basename(filename):
   """Similar to get_file_suffix this strips off all numeric suffixes and then
   then final non-numeric one.  For example for 'libz.so.1.2.8' returns 'libz'"""
-  filename = os.path.basename(filename)
-  while filename:
-    filename, suffix = os.path.splitext(filename)
-    # Keep stipping suffixes until we strip a non-numeric one.
-    if not suffix[1:].isdigit():
-      return filename
+  return split_versioned_suffix(filename)[0]
 
 
 def get_secondary_target(target, ext):
@@ -1069,12 +1329,6 @@ def in_temp(name):
   return os.path.join(temp_dir, os.path.basename(name))
 
 
-def dedup_list(lst):
-  # Since we require python 3.6, that ordering of dictionaries is guaranteed
-  # to be insertion order so we can use 'dict' here but not 'set'.
-  return list(dict.fromkeys(lst))
-
-
 def move_file(src, dst):
   logging.debug('move: %s -> %s', src, dst)
   if os.path.isdir(dst):
@@ -1085,7 +1339,13 @@ def move_file(src, dst):
     return
   if dst == os.devnull:
     return
-  shutil.move(src, dst)
+  try:
+    # Unlike shutil.move, this also renames over an existing file on Windows
+    # rather than falling back to a copy.
+    os.replace(src, dst)
+  except OSError:
+    # e.g. src and dst are on different filesystems
+    shutil.move(src, dst)
 
 
 # Returns the subresource location for run-time access
@@ -1096,8 +1356,7 @@ def get_subresource_location(path, data_uri=None):
     # if the path does not exist, then there is no data to encode
     if not os.path.exists(path):
       return ''
-    data = base64.b64encode(utils.read_binary(path))
-    return 'data:application/octet-stream;base64,' + data.decode('ascii')
+    return 'data:application/octet-stream;base64,' + base64_encode(utils.read_binary(path))
   else:
     return os.path.basename(path)
 
@@ -1392,12 +1651,18 @@ def phase_parse_arguments(state):
   # warnings are properly printed during arg parse.
   newargs = diagnostics.capture_warnings(newargs)
 
-  for i in range(len(newargs)):
-    if newargs[i] in ('-l', '-L', '-I'):
-      # Scan for individual -l/-L/-I arguments and concatenate the next arg on
-      # if there is no suffix
-      newargs[i] += newargs[i + 1]
-      newargs[i + 1] = ''
+  # Scan for individual -l/-L/-I arguments and concatenate the next arg on
+  # if there is no suffix
+  args = newargs
+  newargs = []
+  i = 0
+  while i < len(args):
+    arg = args[i]
+    if arg in ('-l', '-L', '-I'):
+      i += 1
+      arg += args[i]
+    newargs.append(arg)
+    i += 1
 
   options, settings_changes, user_js_defines, newargs = parse_args(newargs)
 
@@ -1428,6 +1693,31 @@ def phase_parse_arguments(state):
   return options, newargs
 
 
+def find_existing_files(paths):
+  """Return the subset of `paths` that are known to exist.
+
+  Directories that contain many of the paths are listed once rather than
+  stat'ing each file.  Paths that are not found this way (including symlinks)
+  are not in the result and should be checked individually by the caller.
+  """
+  names_by_dir = {}
+  for path in paths:
+    dirname, basename = os.path.split(path)
+    names_by_dir.setdefault(dirname, []).append(basename)
+
+  found = set()
+  for dirname, names in names_by_dir.items():
+    if len(names) < LIST_DIR_THRESHOLD:
+      continue
+    try:
+      with os.scandir(dirname or '.') as it:
+        present = {e.name for e in it if not e.is_symlink()}
+    except OSError:
+      continue
+    found.update(os.path.join(dirname, n) for n in names if n in present)
+  return found
+
+
 @ToolchainProfiler.profile_block('setup')
 def phase_setup(options, state, newargs):
   """Second phase: configure and setup the compiler based on the specified settings and arguments.
@@ -1449,6 +1739,8 @@ def phase_setup(options, state, newargs):
   # arguments that expand into multiple processed arguments, as in -Wl,-f1,-f2.
   input_files = []
 
+  existing_inputs = find_existing_files(a for a in newargs if not a.startswith('-'))
+
   # find input files with a simple heuristic. we should really analyze
   # based on a full understanding of gcc params, right now we just assume that
   # what is left contains no more |-x OPT| things
@@ -1460,14 +1752,7 @@ def phase_setup(options, state, newargs):
       continue
 
     arg = newargs[i]
-    if arg in ('-MT', '-MF', '-MJ', '-MQ', '-D', '-U', '-o', '-x',
-               '-Xpreprocessor', '-include', '-imacros', '-idirafter',
-               '-iprefix', '-iwithprefix', '-iwithprefixbefore',
-               '-isysroot', '-imultilib', '-A', '-isystem', '-iquote',
-               '-install_name', '-compatibility_version',
-               '-current_version', '-I', '-L', '-include-pch',
-               '-undefined',
-               '-Xlinker', '-Xclang', '-z'):
+    if arg in SKIP_NEXT_ARGS:
       skip = True
 
     if not arg.startswith('-'):
@@ -1476,18 +1761,22 @@ def phase_setup(options, state, newargs):
       # os.devnul should always be reported as existing but there is bug in windows
       # python before 3.8:
       # https://bugs.python.org/issue1311
-      if not os.path.exists(arg) and arg != os.devnull:
+      if arg not in existing_inputs and not os.path.exists(arg) and arg != os.devnull:
         exit_with_error('%s: No such file or directory ("%s" was expected to be an input file, based on the commandline arguments provided)', arg, arg)
       file_suffix = get_file_suffix(arg)
       if file_suffix in HEADER_ENDINGS:
         has_header_inputs = True
-      if file_suffix in STATICLIB_ENDINGS and not building.is_ar(arg):
-        if building.is_bitcode(arg):
+      # Read the header once and classify it in memory rather than
+      # reopening the file for each of the is_* checks.
+      if file_suffix in STATICLIB_ENDINGS or file_suffix in DYNAMICLIB_ENDINGS:
+        header = building.read_file_header(arg)
+      if file_suffix in STATICLIB_ENDINGS and not building.is_ar_header(header):
+        if building.is_bitcode_header(header):
           message = f'{arg}: File has a suffix of a static library {STATICLIB_ENDINGS}, but instead is an LLVM bitcode file! When linking LLVM bitcode files use .bc or .o.'
         else:
           message = arg + ': Unknown format, not a static library!'
         exit_with_error(message)
-      if file_suffix in DYNAMICLIB_ENDINGS and not building.is_bitcode(arg) and not building.is_wasm(arg):
+      if file_suffix in DYNAMICLIB_ENDINGS and not building.is_bitcode_header(header) and not building.is_wasm_header(header):
         # For shared libraries that are neither bitcode nor wasm, assuming its local native
         # library and attempt to find a library by the same name in our own library path.
         # TODO(sbc): Do we really need this feature?  See test_other.py:test_local_link
@@ -1497,10 +1786,14 @@ def phase_setup(options, state, newargs):
         add_link_flag(state, i, flag)
       else:
         input_files.append((i, arg))
-    elif arg.startswith('-L'):
-      add_link_flag(state, i, arg)
-      newargs[i] = ''
-    elif arg.startswith('-l'):
+      continue
+
+    # Dispatch on the two character prefix so that the common compiler flags
+    # that are left in newargs fall through after a single lookup.
+    prefix = arg[:2]
+    if prefix not in LINK_FLAG_PREFIXES:
+      continue
+    if prefix == '-L' or prefix == '-l':
       add_link_flag(state, i, arg)
       newargs[i] = ''
     elif arg == '-z':
@@ -1508,7 +1801,7 @@ def phase_setup(options, state, newargs):
       add_link_flag(state, i + 1, newargs[i + 1])
       newargs[i] = ''
       newargs[i + 1] = ''
-    elif arg.startswith('-z'):
+    elif prefix == '-z':
       add_link_flag(state, i, newargs[i])
       newargs[i] = ''
     elif arg.startswith('-Wl,'):
@@ -1579,8 +1872,9 @@ def phase_setup(options, state, newargs):
     if options.output_file and len(input_files) > 1:
       exit_with_error('cannot specify -o with -c/-S/-E/-M and multiple source files')
   else:
+    compile_only_prefixes = tuple(COMPILE_ONLY_FLAGS)
     for arg in state.orig_args:
-      if any(arg.startswith(f) for f in COMPILE_ONLY_FLAGS):
+      if arg.startswith(compile_only_prefixes):
         diagnostics.warning(
             'unused-command-line-argument',
             "compiler flag ignored during linking: '%s'" % arg)
@@ -1681,8 +1975,14 @@ def setup_pthreads(target):
 
   default_setting('DEFAULT_PTHREAD_STACK_SIZE', settings.STACK_SIZE)
 
+  # Accumulate additions locally and apply them to settings once at the end.
+  # These are lists rather than sets so that the output order is deterministic.
+  required_exports = []
+  library_funcs = []
+  exported_functions = []
+
   # Functions needs to be exported from the module since they are used in worker.js
-  settings.REQUIRED_EXPORTS += [
+  required_exports += [
     'emscripten_dispatch_to_thread_',
     '_emscripten_thread_free_data',
     'emscripten_main_runtime_thread_id',
@@ -1692,7 +1992,7 @@ def setup_pthreads(target):
   ]
 
   if settings.MAIN_MODULE:
-    settings.REQUIRED_EXPORTS += [
+    required_exports += [
       '_emscripten_dlsync_self',
       '_emscripten_dlsync_self_async',
       '_emscripten_proxy_dlsync',
@@ -1700,9 +2000,7 @@ def setup_pthreads(target):
       '__dl_seterr',
     ]
 
-  settings.DEFAULT_LIBRARY_FUNCS_TO_INCLUDE += [
-    '$exitOnMainThread',
-  ]
+  library_funcs.append('$exitOnMainThread')
   # Some symbols are required by worker.js.
   # Because emitDCEGraph only considers the main js file, and not worker.js
   # we have explicitly mark these symbols as user-exported so that they will
@@ -1718,7 +2016,7 @@ def setup_pthreads(target):
     '_pthread_self',
     'checkMailbox',
   ]
-  settings.EXPORTED_FUNCTIONS += worker_imports
+  exported_functions += worker_imports
   building.user_requested_exports.update(worker_imports)
 
   # set location of worker.js
@@ -1729,19 +2027,19 @@ def setup_pthreads(target):
 
   # All proxying async backends will need this.
   if settings.WASMFS:
-    settings.REQUIRED_EXPORTS += ['emscripten_proxy_finish']
+    required_exports.append('emscripten_proxy_finish')
     # TODO: Remove this once we no longer need the heartbeat hack in
     # wasmfs/thread_utils.h
-    settings.REQUIRED_EXPORTS += ['emscripten_proxy_execute_queue']
+    required_exports.append('emscripten_proxy_execute_queue')
 
   # pthread stack setup and other necessary utilities
-  def include_and_export(name):
-    settings.DEFAULT_LIBRARY_FUNCS_TO_INCLUDE += ['$' + name]
-    settings.EXPORTED_FUNCTIONS += [name]
+  for name in ('establishStackSpace', 'invokeEntryPoint', 'PThread'):
+    library_funcs.append('$' + name)
+    exported_functions.append(name)
 
-  include_and_export('establishStackSpace')
-  include_and_export('invokeEntryPoint')
-  include_and_export('PThread')
+  settings.REQUIRED_EXPORTS += required_exports
+  settings.DEFAULT_LIBRARY_FUNCS_TO_INCLUDE += library_funcs
+  settings.EXPORTED_FUNCTIONS += exported_functions
   if not settings.MINIMAL_RUNTIME:
     # keepRuntimeAlive does not apply to MINIMAL_RUNTIME.
     settings.EXPORTED_RUNTIME_METHODS += ['keepRuntimeAlive', 'ExitStatus', 'wasmMemory']
@@ -1789,17 +2087,7 @@ def phase_linker_setup(options, state, newargs):
     options.post_js.append(utils.path_from_root('src/cpuprofiler.js'))
 
   if not settings.RUNTIME_DEBUG:
-    settings.RUNTIME_DEBUG = bool(settings.LIBRARY_DEBUG or
-                                  settings.GL_DEBUG or
-                                  settings.DYLINK_DEBUG or
-                                  settings.OPENAL_DEBUG or
-                                  settings.SYSCALL_DEBUG or
-                                  settings.WEBSOCKET_DEBUG or
-                                  settings.SOCKET_DEBUG or
-                                  settings.FETCH_DEBUG or
-                                  settings.EXCEPTION_DEBUG or
-                                  settings.PTHREADS_DEBUG or
-                                  settings.ASYNCIFY_DEBUG)
+    settings.RUNTIME_DEBUG = any(settings[name] for name in RUNTIME_DEBUG_SETTINGS)
 
   if options.memory_profiler:
     settings.MEMORYPROFILER = 1
@@ -1836,6 +2124,7 @@ def phase_linker_setup(options, state, newargs):
     target = 'a.out.js'
 
   final_suffix = get_file_suffix(target)
+  target_basename = unsuffixed_basename(target)
 
   if settings.EXTRA_EXPORTED_RUNTIME_METHODS:
     diagnostics.warning('deprecated', 'EXTRA_EXPORTED_RUNTIME_METHODS is deprecated, please use EXPORTED_RUNTIME_METHODS instead')
@@ -1856,14 +2145,10 @@ def phase_linker_setup(options, state, newargs):
       options.oformat = OFormat.OBJECT
 
   if not options.oformat:
-    if settings.SIDE_MODULE or final_suffix == '.wasm':
+    if settings.SIDE_MODULE:
       options.oformat = OFormat.WASM
-    elif final_suffix == '.mjs':
-      options.oformat = OFormat.MJS
-    elif final_suffix == '.html':
-      options.oformat = OFormat.HTML
     else:
-      options.oformat = OFormat.JS
+      options.oformat = SUFFIX_TO_OFORMAT.get(final_suffix, OFormat.JS)
 
   if options.oformat == OFormat.MJS:
     settings.EXPORT_ES6 = 1
@@ -1980,12 +2265,12 @@ def phase_linker_setup(options, state, newargs):
   # It is unlikely that developers targeting "native web" APIs with MINIMAL_RUNTIME need
   # errno support by default.
   if settings.MINIMAL_RUNTIME:
-    default_setting('SUPPORT_ERRNO', 0)
-    # Require explicit -lfoo.js flags to link with JS libraries.
-    default_setting('AUTO_JS_LIBRARIES', 0)
-    # When using MINIMAL_RUNTIME, symbols should only be exported if requested.
-    default_setting('EXPORT_KEEPALIVE', 0)
-    default_setting('USE_GLFW', 0)
+    default_settings(SUPPORT_ERRNO=0,
+                     # Require explicit -lfoo.js flags to link with JS libraries.
+                     AUTO_JS_LIBRARIES=0,
+                     # When using MINIMAL_RUNTIME, symbols should only be exported if requested.
+                     EXPORT_KEEPALIVE=0,
+                     USE_GLFW=0)
 
   if settings.STRICT_JS and (settings.MODULARIZE or settings.EXPORT_ES6):
     exit_with_error("STRICT_JS doesn't work with MODULARIZE or EXPORT_ES6")
@@ -1993,11 +2278,11 @@ def phase_linker_setup(options, state, newargs):
   if settings.STRICT:
     if not settings.MODULARIZE and not settings.EXPORT_ES6:
       default_setting('STRICT_JS', 1)
-    default_setting('AUTO_JS_LIBRARIES', 0)
-    default_setting('AUTO_NATIVE_LIBRARIES', 0)
-    default_setting('AUTO_ARCHIVE_INDEXES', 0)
-    default_setting('IGNORE_MISSING_MAIN', 0)
-    default_setting('ALLOW_UNIMPLEMENTED_SYSCALLS', 0)
+    default_settings(AUTO_JS_LIBRARIES=0,
+                     AUTO_NATIVE_LIBRARIES=0,
+                     AUTO_ARCHIVE_INDEXES=0,
+                     IGNORE_MISSING_MAIN=0,
+                     ALLOW_UNIMPLEMENTED_SYSCALLS=0)
 
   if 'GLOBAL_BASE' not in user_settings and not settings.SHRINK_LEVEL and not settings.OPT_LEVEL:
     # When optimizing for size it helps to put static data first before
@@ -2244,13 +2529,18 @@ def phase_linker_setup(options, state, newargs):
   # are for use when running emscripten modules standalone
   # see https://github.com/emscripten-core/emscripten/issues/18723#issuecomment-1429236996
   if settings.MODULARIZE:
-    default_setting('NODEJS_CATCH_REJECTION', 0)
-    default_setting('NODEJS_CATCH_EXIT', 0)
+    default_settings(NODEJS_CATCH_REJECTION=0, NODEJS_CATCH_EXIT=0)
     if settings.NODEJS_CATCH_REJECTION or settings.NODEJS_CATCH_EXIT:
       exit_with_error('Cannot use -sNODEJS_CATCH_REJECTION or -sNODEJS_CATCH_EXIT with -sMODULARIZE')
 
   setup_environment_settings()
 
+  min_edge = settings.MIN_EDGE_VERSION
+  min_firefox = settings.MIN_FIREFOX_VERSION
+  min_chrome = settings.MIN_CHROME_VERSION
+  min_safari = settings.MIN_SAFARI_VERSION
+  min_ie = settings.MIN_IE_VERSION
+
   if options.use_closure_compiler != 0:
     # Emscripten requires certain ES6 constructs by default in library code
     # - https://caniuse.com/let              : EDGE:12 FF:44 CHROME:49 SAFARI:11
@@ -2260,21 +2550,21 @@ def phase_linker_setup(options, state, newargs):
     #                                          EDGE:12 FF:34 CHROME:45 SAFARI:9
     # Taking the highest requirements gives is our minimum:
     #                             Max Version: EDGE:12 FF:44 CHROME:49 SAFARI:11
-    settings.TRANSPILE_TO_ES5 = (settings.MIN_EDGE_VERSION < 12 or
-                                 settings.MIN_FIREFOX_VERSION < 44 or
-                                 settings.MIN_CHROME_VERSION < 49 or
-                                 settings.MIN_SAFARI_VERSION < 110000 or
-                                 settings.MIN_IE_VERSION != 0x7FFFFFFF)
+    settings.TRANSPILE_TO_ES5 = (min_edge < 12 or
+                                 min_firefox < 44 or
+                                 min_chrome < 49 or
+                                 min_safari < 110000 or
+                                 min_ie != 0x7FFFFFFF)
 
     if options.use_closure_compiler is None and settings.TRANSPILE_TO_ES5:
       diagnostics.warning('transpile', 'enabling transpilation via closure due to browser version settings.  This warning can be suppressed by passing `--closure=1` or `--closure=0` to opt into our explicitly.')
 
   # https://caniuse.com/class: EDGE:13 FF:45 CHROME:49 SAFARI:9
-  supports_es6_classes = (settings.MIN_EDGE_VERSION >= 13 and
-                          settings.MIN_FIREFOX_VERSION >= 45 and
-                          settings.MIN_CHROME_VERSION >= 49 and
-                          settings.MIN_SAFARI_VERSION >= 90000 and
-                          settings.MIN_IE_VERSION == 0x7FFFFFFF)
+  supports_es6_classes = (min_edge >= 13 and
+                          min_firefox >= 45 and
+                          min_chrome >= 49 and
+                          min_safari >= 90000 and
+                          min_ie == 0x7FFFFFFF)
 
   if not settings.DISABLE_EXCEPTION_CATCHING and settings.EXCEPTION_STACK_TRACES and not supports_es6_classes:
     diagnostics.warning('transpile', '-sEXCEPTION_STACK_TRACES requires an engine that support ES6 classes.')
@@ -2329,45 +2619,13 @@ def phase_linker_setup(options, state, newargs):
       # JS API directly. (INCLUDE_FULL_LIBRARY also causes this code to be
       # included, as the entire JS library can refer to things that require
       # these exports.)
-      settings.REQUIRED_EXPORTS += [
-        '_wasmfs_read_file',
-        '_wasmfs_write_file',
-        '_wasmfs_open',
-        '_wasmfs_allocate',
-        '_wasmfs_close',
-        '_wasmfs_write',
-        '_wasmfs_pwrite',
-        '_wasmfs_rename',
-        '_wasmfs_mkdir',
-        '_wasmfs_unlink',
-        '_wasmfs_chdir',
-        '_wasmfs_mknod',
-        '_wasmfs_rmdir',
-        '_wasmfs_read',
-        '_wasmfs_pread',
-        '_wasmfs_symlink',
-        '_wasmfs_truncate',
-        '_wasmfs_ftruncate',
-        '_wasmfs_stat',
-        '_wasmfs_lstat',
-        '_wasmfs_chmod',
-        '_wasmfs_fchmod',
-        '_wasmfs_lchmod',
-        '_wasmfs_utime',
-        '_wasmfs_llseek',
-        '_wasmfs_identify',
-        '_wasmfs_readlink',
-        '_wasmfs_readdir_start',
-        '_wasmfs_readdir_get',
-        '_wasmfs_readdir_finish',
-        '_wasmfs_get_cwd',
-      ]
+      settings.REQUIRED_EXPORTS += WASMFS_JS_API_EXPORTS
 
   if settings.FETCH and final_suffix in EXECUTABLE_ENDINGS:
     state.forced_stdlibs.append('libfetch')
     settings.JS_LIBRARIES.append((0, 'library_fetch.js'))
     if settings.PTHREADS:
-      settings.FETCH_WORKER_FILE = unsuffixed_basename(target) + '.fetch.js'
+      settings.FETCH_WORKER_FILE = target_basename + '.fetch.js'
 
   if settings.DEMANGLE_SUPPORT:
     settings.REQUIRED_EXPORTS += ['__cxa_demangle', 'free']
@@ -2379,9 +2637,8 @@ def phase_linker_setup(options, state, newargs):
 
   # WASM_SYSTEM_EXPORTS are actually native function but they are allowed to be exported
   # via EXPORTED_RUNTIME_METHODS for backwards compat.
-  for sym in settings.WASM_SYSTEM_EXPORTS:
-    if sym in settings.EXPORTED_RUNTIME_METHODS:
-      settings.REQUIRED_EXPORTS.append(sym)
+  runtime_methods = set(settings.EXPORTED_RUNTIME_METHODS)
+  settings.REQUIRED_EXPORTS += [sym for sym in settings.WASM_SYSTEM_EXPORTS if sym in runtime_methods]
 
   settings.REQUIRED_EXPORTS += ['stackSave', 'stackRestore', 'stackAlloc']
 
@@ -2453,7 +2710,7 @@ def phase_linker_setup(options, state, newargs):
     settings.DEFAULT_LIBRARY_FUNCS_TO_INCLUDE += ['$_wasmWorkerInitializeRuntime']
     # set location of Wasm Worker bootstrap JS file
     if settings.WASM_WORKERS == 1:
-      settings.WASM_WORKER_FILE = unsuffixed(os.path.basename(target)) + '.ww.js'
+      settings.WASM_WORKER_FILE = target_basename + '.ww.js'
     settings.JS_LIBRARIES.append((0, shared.path_from_root('src', 'library_wasm_worker.js')))
 
   # Set min browser versions based on certain settings such as WASM_BIGINT,
@@ -2470,7 +2727,7 @@ def phase_linker_setup(options, state, newargs):
 
   if settings.AUDIO_WORKLET:
     if settings.AUDIO_WORKLET == 1:
-      settings.AUDIO_WORKLET_FILE = unsuffixed(os.path.basename(target)) + '.aw.js'
+      settings.AUDIO_WORKLET_FILE = target_basename + '.aw.js'
     settings.JS_LIBRARIES.append((0, shared.path_from_root('src', 'library_webaudio.js')))
     if not settings.MINIMAL_RUNTIME:
       # MINIMAL_RUNTIME exports these manually, since this export mechanism is placed
@@ -2505,9 +2762,10 @@ def phase_linker_setup(options, state, newargs):
     settings.REQUIRED_EXPORTS += ['free']
 
   def check_memory_setting(setting):
-    if settings[setting] % webassembly.WASM_PAGE_SIZE != 0:
-      exit_with_error(f'{setting} must be a multiple of WebAssembly page size (64KiB), was {settings[setting]}')
-    if settings[setting] >= 2**53:
+    value = settings[setting]
+    if value & WASM_PAGE_MASK:
+      exit_with_error(f'{setting} must be a multiple of WebAssembly page size (64KiB), was {value}')
+    if value >= 2**53:
       exit_with_error(f'{setting} must be smaller than 2^53 bytes due to JS Numbers (doubles) being used to hold pointer addresses in JS side')
 
   check_memory_setting('INITIAL_MEMORY')
@@ -2543,10 +2801,11 @@ def phase_linker_setup(options, state, newargs):
   # When not declaring wasm module exports in outer scope one by one, disable minifying
   # wasm module export names so that the names can be passed directly to the outer scope.
   # Also, if using library_exports.js API, disable minification so that the feature can work.
-  if not settings.DECLARE_ASM_MODULE_EXPORTS or '-lexports.js' in [x for _, x in state.link_flags]:
+  link_flag_names = {x for _, x in state.link_flags}
+  if not settings.DECLARE_ASM_MODULE_EXPORTS or '-lexports.js' in link_flag_names:
     settings.MINIFY_WASM_EXPORT_NAMES = 0
 
-  if '-lembind' in [x for _, x in state.link_flags]:
+  if '-lembind' in link_flag_names:
     settings.EMBIND = 1
 
   # Enable minification of wasm imports and exports when appropriate, if we
@@ -2555,8 +2814,8 @@ def phase_linker_setup(options, state, newargs):
   # For example, ASYNCIFY_LAZY_LOAD_CODE needs to identify import names.
   # ASYNCIFY=2 does not support this optimization yet as it has a hardcoded
   # check for 'main' as an export name. TODO
-  if will_metadce() and \
-      settings.OPT_LEVEL >= 2 and \
+  if settings.OPT_LEVEL >= 2 and \
+      will_metadce() and \
       settings.DEBUG_LEVEL <= 2 and \
       options.oformat not in (OFormat.WASM, OFormat.BARE) and \
       settings.ASYNCIFY != 2 and \
@@ -2640,12 +2899,19 @@ def phase_linker_setup(options, state, newargs):
     diagnostics.warning('emcc', 'output suffix .js requested, but wasm side modules are just wasm files; emitting only a .wasm, no .js')
 
   sanitize = set()
+  sanitize_minimal_runtime = False
 
+  # Collect all the sanitizer flags in one pass.  Order matters here since a
+  # later -fno-sanitize= can remove an earlier -fsanitize= (and vice versa).
   for arg in newargs:
+    if not arg.startswith(('-fsanitize', '-fno-sanitize=')):
+      continue
     if arg.startswith('-fsanitize='):
       sanitize.update(arg.split('=', 1)[1].split(','))
     elif arg.startswith('-fno-sanitize='):
       sanitize.difference_update(arg.split('=', 1)[1].split(','))
+    elif arg == '-fsanitize-minimal-runtime':
+      sanitize_minimal_runtime = True
 
   if sanitize:
     settings.USE_OFFSET_CONVERTER = 1
@@ -2673,7 +2939,7 @@ def phase_linker_setup(options, state, newargs):
     settings.DEFAULT_LIBRARY_FUNCS_TO_INCLUDE.append('$UTF8ArrayToString')
 
   if sanitize & UBSAN_SANITIZERS:
-    if '-fsanitize-minimal-runtime' in newargs:
+    if sanitize_minimal_runtime:
       settings.UBSAN_RUNTIME = 1
     else:
       settings.UBSAN_RUNTIME = 2
@@ -2688,20 +2954,6 @@ def phase_linker_setup(options, state, newargs):
     if not settings.UBSAN_RUNTIME:
       settings.UBSAN_RUNTIME = 2
 
-    # helper functions for JS to call into C to do memory operations. these
-    # let us sanitize memory access from the JS side, by calling into C where
-    # it has been instrumented.
-    ASAN_C_HELPERS = [
-      '_asan_c_load_1', '_asan_c_load_1u',
-      '_asan_c_load_2', '_asan_c_load_2u',
-      '_asan_c_load_4', '_asan_c_load_4u',
-      '_asan_c_load_f', '_asan_c_load_d',
-      '_asan_c_store_1', '_asan_c_store_1u',
-      '_asan_c_store_2', '_asan_c_store_2u',
-      '_asan_c_store_4', '_asan_c_store_4u',
-      '_asan_c_store_f', '_asan_c_store_d',
-    ]
-
     settings.REQUIRED_EXPORTS += ASAN_C_HELPERS
 
     if settings.ASYNCIFY and not settings.ASYNCIFY_ONLY:
@@ -2730,31 +2982,34 @@ def phase_linker_setup(options, state, newargs):
     # - user_mem : memory usable/visible by the user program.
     # - shadow_size : memory used by asan for shadow memory.
     # - total_mem : the sum of the above. this is the size of the wasm memory (and must be aligned to WASM_PAGE_SIZE)
-    user_mem = settings.INITIAL_MEMORY
-    if settings.ALLOW_MEMORY_GROWTH:
+    allow_memory_growth = settings.ALLOW_MEMORY_GROWTH
+    initial_memory = settings.INITIAL_MEMORY
+    user_mem = initial_memory
+    if allow_memory_growth:
       user_mem = settings.MAXIMUM_MEMORY
 
     # Given the know value of user memory size we can work backwards
     # to find the total memory and the shadow size based on the fact
     # that the user memory is 7/8ths of the total memory.
     # (i.e. user_mem == total_mem * 7 / 8
-    total_mem = user_mem * 8 / 7
+    # Round up using integer math so we never go via a float.
+    total_mem = (user_mem * 8 + 6) // 7
 
     # But we might need to re-align to wasm page size
-    total_mem = int(align_to_wasm_page_boundary(total_mem))
+    total_mem = align_to_wasm_page_boundary(total_mem)
 
     # The shadow size is 1/8th the resulting rounded up size
-    shadow_size = total_mem // 8
+    shadow_size = total_mem >> 3
 
     # We start our global data after the shadow memory.
     # We don't need to worry about alignment here.  wasm-ld will take care of that.
     settings.GLOBAL_BASE = shadow_size
     settings.STACK_FIRST = False
 
-    if not settings.ALLOW_MEMORY_GROWTH:
+    if not allow_memory_growth:
       settings.INITIAL_MEMORY = total_mem
     else:
-      settings.INITIAL_MEMORY += align_to_wasm_page_boundary(shadow_size)
+      settings.INITIAL_MEMORY = initial_memory + align_to_wasm_page_boundary(shadow_size)
 
     if settings.SAFE_HEAP:
       # SAFE_HEAP instruments ASan's shadow memory accesses.
@@ -2832,14 +3087,9 @@ def phase_linker_setup(options, state, newargs):
     # add the default exports (only used for ASYNCIFY == 2)
     settings.ASYNCIFY_EXPORTS += DEFAULT_ASYNCIFY_EXPORTS
 
-    # return the full import name, including module. The name may
-    # already have a module prefix; if not, we assume it is "env".
-    def get_full_import_name(name):
-      if '.' in name:
-        return name
-      return 'env.' + name
-
-    settings.ASYNCIFY_IMPORTS = [get_full_import_name(i) for i in settings.ASYNCIFY_IMPORTS]
+    # Use the full import name, including module. The name may already have a
+    # module prefix; if not, we assume it is "env".
+    settings.ASYNCIFY_IMPORTS = [i if '.' in i else 'env.' + i for i in settings.ASYNCIFY_IMPORTS]
 
     if settings.ASYNCIFY == 2:
       diagnostics.warning('experimental', '-sASYNCIFY=2 (JSPI) is still experimental')
@@ -2936,8 +3186,10 @@ def phase_linker_setup(options, state, newargs):
     # in standalone mode, crt1 will call the constructors from inside the wasm
     settings.REQUIRED_EXPORTS.append('__wasm_call_ctors')
 
-  settings.PRE_JS_FILES = [os.path.abspath(f) for f in options.pre_js]
-  settings.POST_JS_FILES = [os.path.abspath(f) for f in options.post_js]
+  # Equivalent to os.path.abspath, but without a getcwd() call per file.
+  cwd = os.getcwd()
+  settings.PRE_JS_FILES = [os.path.normpath(os.path.join(cwd, f)) for f in options.pre_js]
+  settings.POST_JS_FILES = [os.path.normpath(os.path.join(cwd, f)) for f in options.post_js]
 
   return target, wasm_target
 
@@ -2957,6 +3209,7 @@ def phase_compile_inputs(options, state, newargs, input_files):
     CC.insert(0, config.COMPILER_WRAPPER)
 
   compile_args = [a for a in newargs if a and not is_link_flag(a)]
+  from tools import system_libs
   system_libs.ensure_sysroot()
 
   def get_language_mode(args):
@@ -2973,14 +3226,23 @@ def phase_compile_inputs(options, state, newargs, input_files):
 
   language_mode = get_language_mode(newargs)
 
+  # The answer only depends on the file suffix, so cache it per suffix.
+  use_cxx_cache = {}
+
   def use_cxx(src):
+    suffix = shared.suffix(src)
+    if suffix not in use_cxx_cache:
+      use_cxx_cache[suffix] = use_cxx_for_suffix(suffix)
+    return use_cxx_cache[suffix]
+
+  def use_cxx_for_suffix(suffix):
     if 'c++' in language_mode or run_via_emxx:
       return True
-    suffix = shared.suffix(src)
     # Next consider the filename
-    if suffix in C_ENDINGS + OBJC_ENDINGS:
+    lang = SUFFIX_TO_LANG.get(suffix)
+    if lang in ('c', 'objc'):
       return False
-    if suffix in CXX_ENDINGS:
+    if lang == 'c++':
       return True
     # Finally fall back to the default
     if settings.DEFAULT_TO_CXX:
@@ -2998,13 +3260,17 @@ def phase_compile_inputs(options, state, newargs, input_files):
     return CC
 
   def get_clang_command(src_file):
-    return get_compiler(src_file) + get_cflags(state.orig_args, use_cxx(src_file)) + compile_args + [src_file]
+    is_cxx = use_cxx(src_file)
+    compiler = CXX if is_cxx else CC
+    return compiler + get_cflags(state.orig_args, is_cxx) + compile_args + [src_file]
 
   def get_clang_command_preprocessed(src_file):
     return get_compiler(src_file) + get_clang_flags(state.orig_args) + compile_args + [src_file]
 
+  target_flags = get_target_flags()
+
   def get_clang_command_asm(src_file):
-    return get_compiler(src_file) + get_target_flags() + compile_args + [src_file]
+    return get_compiler(src_file) + target_flags + compile_args + [src_file]
 
   # preprocessor-only (-E) support
   if state.mode == Mode.PREPROCESS_ONLY:
@@ -3022,6 +3288,9 @@ def phase_compile_inputs(options, state, newargs, input_files):
   # Precompiled headers support
   if state.mode == Mode.PCH:
     headers = [header for _, header in input_files]
+    if options.output_file and len(headers) > 1:
+      exit_with_error('cannot specify -o when generating multiple output files')
+    pch_commands = []
     for header in headers:
       if not shared.suffix(header) in HEADER_ENDINGS:
         exit_with_error(f'cannot mix precompiled headers with non-header inputs: {headers} : {header}')
@@ -3029,8 +3298,14 @@ def phase_compile_inputs(options, state, newargs, input_files):
       if options.output_file:
         cmd += ['-o', options.output_file]
       logger.debug(f"running (for precompiled headers): {cmd[0]} {' '.join(cmd[1:])}")
-      shared.check_call(cmd)
-      return []
+      pch_commands.append(cmd)
+    # Each header is compiled by its own clang process, so they can run in
+    # parallel.
+    if len(pch_commands) > 1:
+      shared.run_multiple_processes(pch_commands)
+    else:
+      shared.check_call(pch_commands[0])
+    return []
 
   linker_inputs = []
   seen_names = {}
@@ -3054,18 +3329,21 @@ def phase_compile_inputs(options, state, newargs, input_files):
     else:
       return in_temp(unsuffixed(uniquename(input_file)) + options.default_object_extension)
 
-  def compile_source_file(i, input_file):
+  compile_commands = []
+  compile_outputs = []
+
+  def compile_source_file(i, input_file, file_suffix):
     logger.debug(f'compiling source file: {input_file}')
     output_file = get_object_filename(input_file)
     if state.mode not in (Mode.COMPILE_ONLY, Mode.PREPROCESS_ONLY):
       linker_inputs.append((i, output_file))
-    if get_file_suffix(input_file) in ASSEMBLY_ENDINGS:
+    if file_suffix in ASSEMBLY_ENDINGS:
       cmd = get_clang_command_asm(input_file)
-    elif get_file_suffix(input_file) in PREPROCESSED_ENDINGS:
+    elif file_suffix in PREPROCESSED_ENDINGS:
       cmd = get_clang_command_preprocessed(input_file)
     else:
       cmd = get_clang_command(input_file)
-      if get_file_suffix(input_file) in ['.pcm']:
+      if file_suffix == '.pcm':
         cmd = [c for c in cmd if not c.startswith('-fprebuilt-module-path=')]
     if not state.has_dash_c:
       cmd += ['-c']
@@ -3078,15 +3356,14 @@ def phase_compile_inputs(options, state, newargs, input_files):
       # driver to perform linking which would be big change.
       cmd += ['-Xclang', '-split-dwarf-file', '-Xclang', unsuffixed_basename(input_file) + '.dwo']
       cmd += ['-Xclang', '-split-dwarf-output', '-Xclang', unsuffixed_basename(input_file) + '.dwo']
-    shared.check_call(cmd)
-    if output_file not in ('-', os.devnull):
-      assert os.path.exists(output_file)
+    compile_commands.append(cmd)
+    compile_outputs.append(output_file)
 
   # First, generate LLVM bitcode. For each input file, we get base.o with bitcode
   for i, input_file in input_files:
     file_suffix = get_file_suffix(input_file)
-    if file_suffix in SOURCE_ENDINGS + ASSEMBLY_ENDINGS or (state.has_dash_c and file_suffix == '.bc'):
-      compile_source_file(i, input_file)
+    if file_suffix in COMPILE_ENDINGS or (state.has_dash_c and file_suffix == '.bc'):
+      compile_source_file(i, input_file, file_suffix)
     elif file_suffix in DYNAMICLIB_ENDINGS:
       logger.debug(f'using shared library: {input_file}')
       linker_inputs.append((i, input_file))
@@ -3094,7 +3371,7 @@ def phase_compile_inputs(options, state, newargs, input_files):
       logger.debug(f'using static library: {input_file}')
       linker_inputs.append((i, input_file))
     elif language_mode:
-      compile_source_file(i, input_file)
+      compile_source_file(i, input_file, file_suffix)
     elif input_file == '-':
       exit_with_error('-E or -x required when input is from standard input')
     else:
@@ -3102,11 +3379,28 @@ def phase_compile_inputs(options, state, newargs, input_files):
       logger.debug(f'using object file: {input_file}')
       linker_inputs.append((i, input_file))
 
+  # Each source file is compiled by a separate clang process, so when there
+  # are several of them we can run them in parallel (limited by EMCC_CORES).
+  # This can be disabled with EMCC_PARALLEL_COMPILE=0.
+  if len(compile_commands) > 1 and os.environ.get('EMCC_PARALLEL_COMPILE', '1') != '0' and \
+     not any(a.startswith(SHARED_OUTPUT_COMPILE_FLAGS) for a in compile_args):
+    shared.run_multiple_processes(compile_commands)
+  else:
+    for cmd in compile_commands:
+      shared.check_call(cmd)
+  # clang's exit status is already checked above, so only double check that the
+  # outputs were written when debugging.
+  if DEBUG:
+    for output_file in compile_outputs:
+      if output_file not in ('-', os.devnull):
+        assert os.path.exists(output_file)
+
   return linker_inputs
 
 
 @ToolchainProfiler.profile_block('calculate system libraries')
 def phase_calculate_system_libraries(state, linker_arguments, newargs):
+  from tools import ports, system_libs
   extra_files_to_link = []
   # Link in ports and system libraries, if necessary
   if not settings.SIDE_MODULE:
@@ -3122,10 +3416,11 @@ def phase_link(linker_arguments, wasm_target, js_syms):
 
   # Make a final pass over settings.EXPORTED_FUNCTIONS to remove any
   # duplication between functions added by the driver/libraries and function
-  # specified by the user
-  settings.EXPORTED_FUNCTIONS = dedup_list(settings.EXPORTED_FUNCTIONS)
-  settings.REQUIRED_EXPORTS = dedup_list(settings.REQUIRED_EXPORTS)
-  settings.EXPORT_IF_DEFINED = dedup_list(settings.EXPORT_IF_DEFINED)
+  # specified by the user.  Since we require python 3.6, dict ordering is
+  # insertion order so dict.fromkeys keeps the first occurrence of each name.
+  settings.EXPORTED_FUNCTIONS = list(dict.fromkeys(settings.EXPORTED_FUNCTIONS))
+  settings.REQUIRED_EXPORTS = list(dict.fromkeys(settings.REQUIRED_EXPORTS))
+  settings.EXPORT_IF_DEFINED = list(dict.fromkeys(settings.EXPORT_IF_DEFINED))
 
   building.link_lld(linker_arguments, wasm_target, external_symbols=js_syms)
 
@@ -3139,7 +3434,7 @@ def phase_post_link(options, state, in_wasm, wasm_target, target, js_syms):
   if options.oformat != OFormat.WASM:
     final_js = in_temp(target_basename + '.js')
 
-  settings.TARGET_BASENAME = unsuffixed_basename(target)
+  settings.TARGET_BASENAME = target_basename
 
   if options.oformat in (OFormat.JS, OFormat.MJS):
     state.js_target = target
@@ -3180,6 +3475,7 @@ def phase_emscript(options, in_wasm, wasm_target, memfile, js_syms):
     # _read in shell.js depends on intArrayToString when SUPPORT_BASE64_EMBEDDING is set
     settings.DEFAULT_LIBRARY_FUNCS_TO_INCLUDE.append('$intArrayToString')
 
+  import emscripten
   emscripten.run(in_wasm, wasm_target, final_js, memfile, js_syms)
   save_intermediate('original')
 
@@ -3188,7 +3484,8 @@ def phase_emscript(options, in_wasm, wasm_target, memfile, js_syms):
 def phase_source_transforms(options):
   # Apply a source code transformation, if requested
   global final_js
-  safe_copy(final_js, final_js + '.tr.js')
+  # The untransformed JS is not used again, so move it rather than copy it.
+  move_file(final_js, final_js + '.tr.js')
   final_js += '.tr.js'
   posix = not shared.WINDOWS
   logger.debug('applying transform: %s', options.js_transform)
@@ -3203,21 +3500,32 @@ def phase_memory_initializer(memfile):
   global final_js
 
   src = read_file(final_js)
-  src = do_replace(src, '<<< MEM_INITIALIZER >>>', '"%s"' % os.path.basename(memfile))
+  # The placeholder only appears once (in preamble.js), so stop at the first match.
+  src = do_replace(src, '<<< MEM_INITIALIZER >>>', '"%s"' % os.path.basename(memfile), count=1)
   write_file(final_js + '.mem.js', src)
   final_js += '.mem.js'
 
 
-def create_worker_file(input_file, target_dir, output_file):
-  output_file = os.path.join(target_dir, output_file)
-  input_file = utils.path_from_root(input_file)
-  contents = shared.read_and_preprocess(input_file, expand_macros=True)
-  write_file(output_file, contents)
+def create_worker_files(worker_files, target_dir):
+  if not worker_files:
+    return
+  # Each file is preprocessed (and then minified) by a separate node process,
+  # which write their output directly to the final location, so run them in
+  # parallel.
+  settings_file = shared.write_preprocessor_settings()
+  cmds = []
+  output_files = []
+  for input_file, output_file in worker_files:
+    cmds.append(shared.get_preprocessor_command(settings_file, utils.path_from_root(input_file), expand_macros=True))
+    output_files.append(os.path.join(target_dir, output_file))
+  # Like read_and_preprocess, run from the src directory so that the
+  # preprocessor never picks up same-named files from the user's directory.
+  shared.run_multiple_processes(cmds, stdout_files=output_files, cwd=utils.path_from_root('src'))
 
   # Minify the worker JS files file in optimized builds
   if (settings.OPT_LEVEL >= 1 or settings.SHRINK_LEVEL >= 1) and not settings.DEBUG_LEVEL:
-    contents = building.acorn_optimizer(output_file, ['minifyWhitespace'], return_output=True)
-    write_file(output_file, contents)
+    cmds = [building.get_acorn_optimizer_command(f, ['minifyWhitespace']) + ['-o', f] for f in output_files]
+    shared.run_multiple_processes(cmds)
 
 
 @ToolchainProfiler.profile_block('final emitting')
@@ -3225,16 +3533,19 @@ def phase_final_emitting(options, state, target, wasm_target, memfile):
   global final_js
 
   target_dir = os.path.dirname(os.path.abspath(target))
+  worker_files = []
   if settings.PTHREADS:
-    create_worker_file('src/worker.js', target_dir, settings.PTHREAD_WORKER_FILE)
+    worker_files.append(('src/worker.js', settings.PTHREAD_WORKER_FILE))
 
   # Deploy the Wasm Worker bootstrap file as an output file (*.ww.js)
   if settings.WASM_WORKERS == 1:
-    create_worker_file('src/wasm_worker.js', target_dir, settings.WASM_WORKER_FILE)
+    worker_files.append(('src/wasm_worker.js', settings.WASM_WORKER_FILE))
 
   # Deploy the Audio Worklet module bootstrap file (*.aw.js)
   if settings.AUDIO_WORKLET == 1:
-    create_worker_file('src/audio_worklet.js', target_dir, settings.AUDIO_WORKLET_FILE)
+    worker_files.append(('src/audio_worklet.js', settings.AUDIO_WORKLET_FILE))
+
+  create_worker_files(worker_files, target_dir)
 
   if settings.MODULARIZE:
     modularize()
@@ -3251,30 +3562,27 @@ def phase_final_emitting(options, state, target, wasm_target, memfile):
     # mode)
     final_js = building.closure_compiler(final_js, pretty=False, advanced=False, extra_closure_args=options.closure_args)
 
-  # Unmangle previously mangled `import.meta` and `await import` references in
-  # both main code and libraries.
-  # See also: `preprocess` in parseTools.js.
-  if settings.EXPORT_ES6 and settings.USE_ES6_IMPORT_META:
+  unmangle_import_meta = settings.EXPORT_ES6 and settings.USE_ES6_IMPORT_META
+  apply_extern_pre_post = options.extern_pre_js or options.extern_post_js
+  if unmangle_import_meta or apply_extern_pre_post:
+    # Do the remaining source transforms, and the license handling, in a
+    # single read/write of the JS.
     src = read_file(final_js)
-    final_js += '.esmeta.js'
-    write_file(final_js, src
-               .replace('EMSCRIPTEN$IMPORT$META', 'import.meta')
-               .replace('EMSCRIPTEN$AWAIT$IMPORT', 'await import'))
+    # Unmangle previously mangled `import.meta` and `await import` references in
+    # both main code and libraries.
+    # See also: `preprocess` in parseTools.js.
+    if unmangle_import_meta:
+      src = ES6_IMPORT_META_RE.sub(lambda m: ES6_IMPORT_META_REPLACEMENTS[m.group(1)], src)
+    # Apply pre and postjs files
+    if apply_extern_pre_post:
+      logger.debug('applying extern pre/postjses')
+      src = options.extern_pre_js + src + options.extern_post_js
+    final_js += '.final.js'
+    write_file(final_js, js_manipulation.apply_license(src))
     shared.get_temp_files().note(final_js)
-    save_intermediate('es6-module')
-
-  # Apply pre and postjs files
-  if options.extern_pre_js or options.extern_post_js:
-    logger.debug('applying extern pre/postjses')
-    src = read_file(final_js)
-    final_js += '.epp.js'
-    with open(final_js, 'w', encoding='utf-8') as f:
-      f.write(options.extern_pre_js)
-      f.write(src)
-      f.write(options.extern_post_js)
-    save_intermediate('extern-pre-post')
-
-  js_manipulation.handle_license(final_js)
+    save_intermediate('final')
+  else:
+    js_manipulation.handle_license(final_js)
 
   js_target = state.js_target
 
@@ -3308,14 +3616,35 @@ def phase_final_emitting(options, state, target, wasm_target, memfile):
     write_file(options.embind_emit_tsd, out)
 
 
+def read_git_revision(git_dir):
+  """Read the revision of HEAD straight from the git directory, without
+  running git.  Returns None when that isn't possible (e.g. in a worktree, or
+  when the branch only exists in packed-refs)."""
+  head_file = os.path.join(git_dir, 'HEAD')
+  if not os.path.isfile(head_file):
+    return None
+  head = read_file(head_file).strip()
+  if not head.startswith('ref: '):
+    # Detached HEAD
+    return head
+  ref_file = os.path.join(git_dir, removeprefix(head, 'ref: '))
+  if not os.path.isfile(ref_file):
+    return None
+  return read_file(ref_file).strip()
+
+
+@functools.lru_cache(maxsize=None)
 def version_string():
   # if the emscripten folder is not a git repo, don't run git show - that can
   # look up and find the revision in a parent directory that is a git repo
   revision_suffix = ''
-  if os.path.exists(utils.path_from_root('.git')):
-    git_rev = run_process(
-      ['git', 'rev-parse', 'HEAD'],
-      stdout=PIPE, stderr=PIPE, cwd=utils.path_from_root()).stdout.strip()
+  git_dir = utils.path_from_root('.git')
+  if os.path.exists(git_dir):
+    git_rev = read_git_revision(git_dir)
+    if not git_rev:
+      git_rev = run_process(
+        ['git', 'rev-parse', 'HEAD'],
+        stdout=PIPE, stderr=PIPE, cwd=utils.path_from_root()).stdout.strip()
     revision_suffix = ' (%s)' % git_rev
   elif os.path.exists(utils.path_from_root('emscripten-revision.txt')):
     rev = read_file(utils.path_from_root('emscripten-revision.txt')).strip()
@@ -3341,6 +3670,10 @@ def parse_args(newargs):
       newargs[i] = '-lembind'
 
     arg = newargs[i]
+    # Every option handled below starts with '-', so input files and values
+    # already consumed by a previous option can be skipped right away.
+    if not arg.startswith('-'):
+      continue
     arg_value = None
 
     def check_flag(value):
@@ -3378,7 +3711,10 @@ def parse_args(newargs):
         exit_with_error("'%s': file not found: '%s'" % (arg, name))
       return name
 
-    if arg.startswith('-O'):
+    if arg in LEGACY_IGNORED_FLAGS:
+      diagnostics.warning('legacy-settings', LEGACY_IGNORED_FLAGS[arg])
+      newargs[i] = ''
+    elif arg.startswith('-O'):
       # Let -O default to -O2, which is what gcc does.
       requested_level = removeprefix(arg, '-O') or '2'
       if requested_level == 's':
@@ -3502,8 +3838,6 @@ def parse_args(newargs):
       options.exclude_files.append(consume_arg())
     elif check_flag('--use-preload-cache'):
       options.use_preload_cache = True
-    elif check_flag('--no-heap-copy'):
-      diagnostics.warning('legacy-settings', 'ignoring legacy flag --no-heap-copy (that is the only mode supported now)')
     elif check_flag('--use-preload-plugins'):
       options.use_preload_plugins = True
     elif check_flag('--ignore-dynamic-linking'):
@@ -3521,8 +3855,6 @@ def parse_args(newargs):
       options.no_entry = True
     elif check_arg('--js-library'):
       settings.JS_LIBRARIES.append((i + 1, os.path.abspath(consume_arg_file())))
-    elif check_flag('--remove-duplicates'):
-      diagnostics.warning('legacy-settings', '--remove-duplicates is deprecated as it is no longer needed. If you cannot link without it, file a bug with a testcase')
     elif check_flag('--jcache'):
       logger.error('jcache is no longer supported')
     elif check_arg('--cache'):
@@ -3538,6 +3870,7 @@ def parse_args(newargs):
       should_exit = True
     elif check_flag('--clear-ports'):
       logger.info('clearing ports and cache as requested by --clear-ports')
+      from tools import ports
       ports.clear()
       cache.erase()
       shared.perform_sanity_checks() # this is a good time for a sanity check
@@ -3547,6 +3880,7 @@ def parse_args(newargs):
       shared.check_sanity(force=True)
       should_exit = True
     elif check_flag('--show-ports'):
+      from tools import ports
       ports.show_ports()
       should_exit = True
     elif check_arg('--memory-init-file'):
@@ -3844,11 +4178,20 @@ def phase_binaryen(target, options, wasm_target):
     js = read_file(final_js)
 
     if settings.MINIMAL_RUNTIME:
-      js = do_replace(js, '<<< WASM_BINARY_DATA >>>', base64_encode(read_binary(wasm_target)))
+      # Stream the encoded wasm binary straight into the output in place of
+      # the placeholder.
+      pattern = '<<< WASM_BINARY_DATA >>>'
+      before, found, after = js.partition(pattern)
+      if not found:
+        exit_with_error('expected to find pattern in input JS: %s' % pattern)
+      with open(final_js, 'w', encoding='utf-8') as f:
+        f.write(before)
+        base64_encode_file(wasm_target, f)
+        f.write(after)
     else:
       js = do_replace(js, '<<< WASM_BINARY_FILE >>>', get_subresource_location(wasm_target))
+      write_file(final_js, js)
     delete_file(wasm_target)
-    write_file(final_js, js)
 
 
 def node_es6_imports():
@@ -3970,7 +4313,7 @@ def module_export_name_substitution():
     replacement = settings.EXPORT_NAME
   else:
     replacement = "typeof %(EXPORT_NAME)s !== 'undefined' ? %(EXPORT_NAME)s : {}" % {"EXPORT_NAME": settings.EXPORT_NAME}
-  new_src = re.sub(r'{\s*[\'"]?__EMSCRIPTEN_PRIVATE_MODULE_EXPORT_NAME_SUBSTITUTION__[\'"]?:\s*1\s*}', replacement, src)
+  new_src = EXPORT_NAME_SUBSTITUTION_RE.sub(replacement, src)
   assert new_src != src, 'Unable to find Closure syntax __EMSCRIPTEN_PRIVATE_MODULE_EXPORT_NAME_SUBSTITUTION__ in source!'
   write_file(final_js, new_src)
   shared.get_temp_files().note(final_js)
@@ -4193,6 +4536,7 @@ def process_libraries(state, linker_inputs, embind_emit_tsd):
   new_flags = []
   libraries = []
   suffixes = STATICLIB_ENDINGS + DYNAMICLIB_ENDINGS
+  from tools import system_libs
   system_libs_map = system_libs.Library.get_usable_variations()
 
   # Find library files
@@ -4259,6 +4603,7 @@ class ScriptSource:
     """Use this if you want to modify the script and need it to be inline."""
     if self.src is None:
       return
+    from urllib.parse import quote
     quoted_src = quote(self.src)
     if settings.EXPORT_ES6:
       self.inline = f'''
@@ -4276,6 +4621,7 @@ class ScriptSource:
     """Returns the script tag to replace the {{{ SCRIPT }}} tag in the target"""
     assert (self.src or self.inline) and not (self.src and self.inline)
     if self.src:
+      from urllib.parse import quote
       quoted_src = quote(self.src)
       if settings.EXPORT_ES6:
         return f'''
@@ -566,6 +566,23 @@ There is NO warranty; not even for MERCHANTABILITY or FITNESS FOR A PARTICULAR P
     self.assertNotExists(test_file('twopart_main.o'))
     self.assertNotExists(test_file('twopart_side.o'))
 
+  @parameterized({
+    'parallel': ('1',),
+    'serial': ('0',),
+  })
+  def test_multiple_sources_error(self, parallel):
+    # When one of several sources fails to compile, clang's failure should be
+    # reported in the same way whether or not the sources are compiled in
+    # parallel.
+    create_file('good.c', 'int good() { return 0; }')
+    create_file('bad.c', 'int bad() { return undeclared; }')
+    with env_modify({'EMCC_PARALLEL_COMPILE': parallel}):
+      err = self.expect_fail([EMCC, '-c', 'good.c', 'bad.c'])
+    self.assertContained("use of undeclared identifier 'undeclared'", err)
+    self.assertContained('bad.c -o bad.o\' failed (returned 1)', err)
+    self.assertNotContained('Subprocess', err)
+    self.assertNotExists('bad.o')
+
   def test_tsearch(self):
     self.do_other_test('test_tsearch.c')
 
@@ -1332,6 +1349,27 @@ int f() {
     self.emcc('main.c', ['libA.so', 'libA.so'], output_filename='a.out.js')
     self.assertContained('result: 1', self.run_js('a.out.js'))
 
+  @no_windows('Windows does not support symlinks')
+  def test_redundant_link_symlink(self):
+    # Duplicate inputs are detected by their realpath, so the same library
+    # passed once directly and once via a symlinked directory is only linked
+    # once (otherwise `mult` would be multiply defined).
+    create_file('libA.c', 'int mult() { return 1; }')
+    create_file('main.c', r'''
+      #include <stdio.h>
+      int mult();
+      int main() {
+        printf("result: %d\n", mult());
+        return 0;
+      }
+    ''')
+
+    self.emcc_args.remove('-Werror')
+    self.emcc('libA.c', ['-shared'], output_filename='libA.so')
+    os.symlink('.', 'linked')
+    self.emcc('main.c', ['libA.so', 'linked/libA.so'], output_filename='a.out.js')
+    self.assertContained('result: 1', self.run_js('a.out.js'))
+
   @no_mac('https://github.com/emscripten-core/emscripten/issues/16649')
   @crossplatform
   def test_dot_a_all_contents_invalid(self):
@@ -4017,6 +4055,18 @@ int main() {
     output = self.run_js('a.out.js')
     self.assertContained('|5|', output)
 
+    # each of several headers gets its own precompiled header
+    create_file('header2.h', '#define Y 6\n')
+    delete_file('header.h.gch')
+    self.run_process([EMCC, '-xc++-header', 'header.h', 'header2.h'])
+    self.assertExists('header.h.gch')
+    self.assertExists('header2.h.gch')
+
+    # but a single -o cannot name more than one of them
+    err = self.expect_fail([EMCC, '-xc++-header', 'header.h', 'header2.h', '-o', 'out.' + suffix])
+    self.assertContained('cannot specify -o when generating multiple output files', err)
+    self.assertNotExists('out.' + suffix)
+
   def test_LEGACY_VM_SUPPORT(self):
     # when modern features are lacking, we can polyfill them or at least warn
     create_file('pre.js', 'Math.imul = undefined;')
@@ -11115,6 +11165,16 @@ Aborted(Module.arguments has been replaced with plain arguments_ (the initial va
     # libpthread_stub.a
     self.do_other_test('test_pthread_stub.c')
 
+  @node_pthreads
+  def test_pthread_worker_preprocess_cwd(self):
+    # The worker JS files are preprocessed in parallel; make sure the
+    # preprocessor still loads its own modules rather than same-named files
+    # in the current directory.
+    create_file('modules.js', 'throw new Error("wrong modules.js");')
+    self.set_setting('PROXY_TO_PTHREAD')
+    self.set_setting('EXIT_RUNTIME')
+    self.do_runf('hello_world.c', 'hello, world!', emcc_args=['-pthread'])
+
   @node_pthreads
   def test_main_pthread_join_detach(self):
     # Verify that we're unable to join the main thread
@@ -13104,14 +13164,18 @@ j1: 8589934599, j2: 30064771074, j3: 12884901891
                  assert_returncode=NON_ZERO)
 
   @crossplatform
-  def test_reproduce(self):
-    self.run_process([EMCC, '-sASSERTIONS=1', '--reproduce=foo.tar', test_file('hello_world.c')])
-    self.assertExists('foo.tar')
+  @parameterized({
+    '': ('foo.tar', 'r'),
+    'gz': ('foo.tar.gz', 'r:gz'),
+  })
+  def test_reproduce(self, archive, mode):
+    self.run_process([EMCC, '-sASSERTIONS=1', '--reproduce=' + archive, test_file('hello_world.c')])
+    self.assertExists(archive)
     names = []
     root = os.path.splitdrive(path_from_root())[1][1:]
     root = root.replace('\\', '/')
     print('root: %s' % root)
-    with tarfile.open('foo.tar') as f:
+    with tarfile.open(archive, mode) as f:
       for name in f.getnames():
         print('name: %s' % name)
         names.append(name.replace(root, '<root>'))
@@ -13,7 +13,7 @@ import shlex
 import shutil
 import subprocess
 import sys
-from typing import Set, Dict
+from typing import Set, Dict, Tuple
 from subprocess import PIPE
 
 from . import cache
@@ -41,6 +41,7 @@ binaryen_checked = False
 EXPECTED_BINARYEN_VERSION = 114
 
 _is_ar_cache: Dict[str, bool] = {}
+_is_wasm_dylib_cache: Dict[Tuple[str, int, int], bool] = {}
 # the exports the user requested
 user_requested_exports: Set[str] = set()
 
@@ -326,16 +327,8 @@ def js_optimizer(filename, passes):
 
 
 # run JS optimizer on some JS, ignoring asm.js contents if any - just run on it all
-def acorn_optimizer(filename, passes, extra_info=None, return_output=False):
+def get_acorn_optimizer_command(filename, passes):
   optimizer = path_from_root('tools/acorn-optimizer.js')
-  original_filename = filename
-  if extra_info is not None:
-    temp_files = shared.get_temp_files()
-    temp = temp_files.get('.js', prefix='emcc_acorn_info_').name
-    shutil.copyfile(filename, temp)
-    with open(temp, 'a') as f:
-      f.write('// EXTRA_INFO: ' + extra_info)
-    filename = temp
   cmd = config.NODE_JS + [optimizer, filename] + passes
   # Keep JS code comments intact through the acorn optimization pass so that JSDoc comments
   # will be carried over to a later Closure run.
@@ -345,6 +338,19 @@ def acorn_optimizer(filename, passes, extra_info=None, return_output=False):
     cmd += ['--exportES6']
   if settings.VERBOSE:
     cmd += ['verbose']
+  return cmd
+
+
+def acorn_optimizer(filename, passes, extra_info=None, return_output=False):
+  original_filename = filename
+  if extra_info is not None:
+    temp_files = shared.get_temp_files()
+    temp = temp_files.get('.js', prefix='emcc_acorn_info_').name
+    shutil.copyfile(filename, temp)
+    with open(temp, 'a') as f:
+      f.write('// EXTRA_INFO: ' + extra_info)
+    filename = temp
+  cmd = get_acorn_optimizer_command(filename, passes)
   if return_output:
     return check_call(cmd, stdout=PIPE).stdout
 
@@ -1046,42 +1052,67 @@ def is_ar(filename):
     return False
 
 
-def is_bitcode(filename):
+# Enough bytes to classify a file with the is_*_header helpers below (the
+# macOS bitcode wrapper has a 20-byte prefix before the 'BC' magic).
+FILE_HEADER_SIZE = 22
+
+
+def read_file_header(filename):
+  """Read the leading bytes of a file, or b'' if it cannot be read."""
   try:
-    # look for magic signature
-    b = open(filename, 'rb').read(4)
-    if b[:2] == b'BC':
-      return True
-    # on macOS, there is a 20-byte prefix which starts with little endian
-    # encoding of 0x0B17C0DE
-    elif b == b'\xDE\xC0\x17\x0B':
-      b = bytearray(open(filename, 'rb').read(22))
-      return b[20:] == b'BC'
-  except IndexError:
-    # not enough characters in the input
-    # note that logging will be done on the caller function
-    pass
-  return False
+    with open(filename, 'rb') as f:
+      return f.read(FILE_HEADER_SIZE)
+  except OSError:
+    return b''
+
+
+def is_ar_header(header):
+  return header[:8] in (b'!<arch>\n', b'!<thin>\n')
+
+
+def is_bitcode_header(header):
+  # look for magic signature
+  if header[:2] == b'BC':
+    return True
+  # on macOS, there is a 20-byte prefix which starts with little endian
+  # encoding of 0x0B17C0DE
+  return header[:4] == b'\xDE\xC0\x17\x0B' and header[20:22] == b'BC'
+
+
+def is_wasm_header(header):
+  return header[:webassembly.HEADER_SIZE] == webassembly.MAGIC + webassembly.VERSION
+
+
+def is_bitcode(filename):
+  return is_bitcode_header(read_file_header(filename))
 
 
 def is_wasm(filename):
   if not os.path.isfile(filename):
     return False
-  header = open(filename, 'rb').read(webassembly.HEADER_SIZE)
-  return header == webassembly.MAGIC + webassembly.VERSION
+  return is_wasm_header(read_file_header(filename))
 
 
 def is_wasm_dylib(filename):
   """Detect wasm dynamic libraries by the presence of the "dylink" custom section."""
-  if not is_wasm(filename):
+  if not os.path.isfile(filename):
     return False
-  with webassembly.Module(filename) as module:
-    section = next(module.sections())
-    if section.type == webassembly.SecType.CUSTOM:
-      module.seek(section.offset)
-      if module.read_string() in ('dylink', 'dylink.0'):
-        return True
-  return False
+  # Key the cache on the file contents (approximated by mtime and size) as well
+  # as its absolute path, so that a file that is rewritten, or a different file
+  # with the same relative name, is checked again.
+  st = os.stat(filename)
+  key = (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+  if key in _is_wasm_dylib_cache:
+    return _is_wasm_dylib_cache[key]
+  result = False
+  if is_wasm(filename):
+    with webassembly.Module(filename) as module:
+      section = next(module.sections())
+      if section.type == webassembly.SecType.CUSTOM:
+        module.seek(section.offset)
+        result = module.read_string() in ('dylink', 'dylink.0')
+  _is_wasm_dylib_cache[key] = result
+  return result
 
 
 def map_to_js_libs(library_name, emit_tsd):
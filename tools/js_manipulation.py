@@ -58,13 +58,18 @@ def add_files_pre_js(pre_js_list, files_pre_js):
   pre_js_list.append(post)
 
 
-def handle_license(js_target):
+def apply_license(js):
   # ensure we emit the license if and only if we need to, and exactly once
-  js = utils.read_file(js_target)
   # first, remove the license as there may be more than once
   processed_js = re.sub(emscripten_license_regex, '', js)
   if settings.EMIT_EMSCRIPTEN_LICENSE:
     processed_js = emscripten_license + processed_js
+  return processed_js
+
+
+def handle_license(js_target):
+  js = utils.read_file(js_target)
+  processed_js = apply_license(js)
   if processed_js != js:
     utils.write_file(js_target, processed_js)
 
@@ -179,12 +179,20 @@ class SettingsManager:
     if self.allowed_settings:
       assert attr in self.allowed_settings, f"internal error: attempt to read setting '{attr}' while in limited settings mode"
 
-    if attr in self.attrs:
+    # This is called for every settings.FOO read, so use a single dict lookup.
+    try:
       return self.attrs[attr]
-    else:
-      raise AttributeError(f"no such setting: '{attr}'")
+    except KeyError:
+      raise AttributeError(f"no such setting: '{attr}'") from None
 
   def __setattr__(self, name, value):
+    # `settings.FOO += [...]` extends the stored list in place and then assigns
+    # the same list back.  It was already validated when first stored so there
+    # is nothing left to do (unless the name needs special handling below).
+    if type(value) is list and self.attrs.get(name) is value and not self.allowed_settings \
+       and name not in self.legacy_settings and name not in self.alt_names:
+      return
+
     if self.allowed_settings:
       assert name in self.allowed_settings, f"internal error: attempt to write setting '{name}' while in limited settings mode"
 
@@ -150,12 +150,25 @@ def cap_max_workers_in_pool(max_workers):
 
 def run_multiple_processes(commands,
                            env=None,
-                           route_stdout_to_temp_files_suffix=None):
-  """Runs multiple subprocess commands.
+                           route_stdout_to_temp_files_suffix=None,
+                           stdout_files=None,
+                           cwd=None):
+  """Runs multiple subprocess commands, up to EMCC_CORES of them at a time.
+
+  Failures are reported in the same way as `check_call`.  On the first failure
+  any commands that are still running are killed and the remaining ones are
+  not started.
 
   route_stdout_to_temp_files_suffix : string
     if not None, all stdouts are instead written to files, and an array
     of filenames is returned.
+
+  stdout_files : list
+    if not None, the stdout of each command is written to the corresponding
+    file in this list.
+
+  cwd : string
+    if not None, the directory in which to run the commands.
   """
 
   if env is None:
@@ -188,33 +201,52 @@ def run_multiple_processes(commands,
       except subprocess.TimeoutExpired:
         pass
 
+  # Flush standard streams otherwise the output of the subprocesses may appear
+  # in the output before messages that we have already written.
+  sys.stdout.flush()
+  sys.stderr.flush()
+
   num_parallel_processes = get_num_cores()
   temp_files = get_temp_files()
   i = 0
   num_completed = 0
-  while num_completed < len(commands):
-    if i < len(commands) and len(processes) < num_parallel_processes:
-      # Not enough parallel processes running, spawn a new one.
-      if route_stdout_to_temp_files_suffix:
-        stdout = temp_files.get(route_stdout_to_temp_files_suffix)
+  try:
+    while num_completed < len(commands):
+      if i < len(commands) and len(processes) < num_parallel_processes:
+        # Not enough parallel processes running, spawn a new one.
+        if route_stdout_to_temp_files_suffix:
+          stdout = temp_files.get(route_stdout_to_temp_files_suffix)
+        elif stdout_files:
+          stdout = open(stdout_files[i], 'w')
+        else:
+          stdout = None
+        if DEBUG:
+          logger.debug('Running subprocess %d/%d: %s' % (i + 1, len(commands), ' '.join(commands[i])))
+        print_compiler_stage(commands[i])
+        try:
+          proc = subprocess.Popen(commands[i], stdout=stdout, stderr=None, env=env, cwd=cwd)
+        except OSError as e:
+          exit_with_error("'%s' failed: %s", shlex_join(commands[i]), str(e))
+        finally:
+          if stdout_files:
+            stdout.close()
+        processes[i] = proc
+        if route_stdout_to_temp_files_suffix:
+          std_outs.append((i, stdout.name))
+        i += 1
       else:
-        stdout = None
-      if DEBUG:
-        logger.debug('Running subprocess %d/%d: %s' % (i + 1, len(commands), ' '.join(commands[i])))
-      print_compiler_stage(commands[i])
-      proc = subprocess.Popen(commands[i], stdout=stdout, stderr=None, env=env)
-      processes[i] = proc
-      if route_stdout_to_temp_files_suffix:
-        std_outs.append((i, stdout.name))
-      i += 1
-    else:
-      # Not spawning a new process (Too many commands running in parallel, or
-      # no commands left): find if a process has finished.
-      idx = get_finished_process()
-      finished_process = processes.pop(idx)
-      if finished_process.returncode != 0:
-        exit_with_error('Subprocess %d/%d failed (%s)! (cmdline: %s)' % (idx + 1, len(commands), returncode_to_str(finished_process.returncode), shlex_join(commands[idx])))
-      num_completed += 1
+        # Not spawning a new process (Too many commands running in parallel, or
+        # no commands left): find if a process has finished.
+        idx = get_finished_process()
+        finished_process = processes.pop(idx)
+        if finished_process.returncode != 0:
+          exit_with_error("'%s' failed (%s)", shlex_join(commands[idx]), returncode_to_str(finished_process.returncode))
+        num_completed += 1
+  finally:
+    for proc in processes.values():
+      if proc.poll() is None:
+        proc.kill()
+        proc.wait()
 
   if route_stdout_to_temp_files_suffix:
     # If processes finished out of order, sort the results to the order of the input.
@@ -691,9 +723,10 @@ def safe_copy(src, dst):
   make_writable(dst)
 
 
-def read_and_preprocess(filename, expand_macros=False):
+def write_preprocessor_settings():
+  """Create a settings file with the current settings to pass to the JS
+  preprocessor."""
   temp_dir = get_emscripten_temp_dir()
-  # Create a settings file with the current settings to pass to the JS preprocessor
 
   settings_str = ''
   for key, value in settings.external_dict().items():
@@ -703,6 +736,21 @@ def read_and_preprocess(filename, expand_macros=False):
 
   settings_file = os.path.join(temp_dir, 'settings.js')
   utils.write_file(settings_file, settings_str)
+  return settings_file
+
+
+def get_preprocessor_command(settings_file, filename, expand_macros=False):
+  """Return the command that runs the JS preprocessor on `filename`, writing
+  the result to stdout."""
+  cmd = config.NODE_JS + [path_from_root('tools/preprocessor.js'), settings_file, filename]
+  if expand_macros:
+    cmd += ['--expandMacros']
+  return cmd
+
+
+def read_and_preprocess(filename, expand_macros=False):
+  temp_dir = get_emscripten_temp_dir()
+  settings_file = write_preprocessor_settings()
 
   # Run the JS preprocessor
   # N.B. We can't use the default stdout=PIPE here as it only allows 64K of output before it hangs
@@ -722,10 +770,10 @@ def read_and_preprocess(filename, expand_macros=False):
   return out
 
 
-def do_replace(input_, pattern, replacement):
+def do_replace(input_, pattern, replacement, count=-1):
   if pattern not in input_:
     exit_with_error('expected to find pattern in input JS: %s' % pattern)
-  return input_.replace(pattern, replacement)
+  return input_.replace(pattern, replacement, count)
 
 
 def get_llvm_target():
@@ -47,12 +47,31 @@ def to_leb(num):
   return leb128.u.encode(num)
 
 
+# These decode directly from the reader rather than going via
+# leb128.*.decode_reader, which first copies the bytes into a bytearray.  They
+# are called for every integer in the sections we parse (e.g. dylink.0).
 def read_uleb(iobuf):
-  return leb128.u.decode_reader(iobuf)[0]
+  result = 0
+  shift = 0
+  while True:
+    byte = iobuf.read(1)[0]
+    result |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return result
+    shift += 7
 
 
 def read_sleb(iobuf):
-  return leb128.i.decode_reader(iobuf)[0]
+  result = 0
+  shift = 0
+  while True:
+    byte = iobuf.read(1)[0]
+    result |= (byte & 0x7f) << shift
+    shift += 7
+    if not byte & 0x80:
+      if byte & 0x40:
+        result -= 1 << shift
+      return result
 
 
 def memoize(method):